@@ -1,13 +1,40 @@
 import argparse
 import sys
+from importlib import import_module
+
+import durability
+from bchoc import env_durability, filepath_to_chain, profile_dump, profile_enabled
+from block import DEFAULT_HASH, HASHES
+from client import forward
+from durability import Durability
 
 
 #print("Usage: bchoc [log | remove] [-r] [-n num_entries] [-c case_id] [-i item_id]")
 
 
+def durability_type(text):
+    try:
+        return Durability.parse(text)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def count_type(text):
+    try:
+        count = int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not a whole number: {text}")
+    if count < 0:
+        raise argparse.ArgumentTypeError(f"must not be negative: {text}")
+    return count
+
+
 # parse bchoc
 parser = argparse.ArgumentParser(description='Process bchoc commands')
 parser.add_argument('bchoc', help='Main command')
+parser.add_argument('--profile', action='store_true', default=profile_enabled, help='Print wall and CPU time per phase, bytes read and written and blocks touched as JSON on stderr')
+parser.add_argument('--profile-dump', metavar='FILE', default=profile_dump, help='Also write cProfile stats to FILE, implies --profile')
+parser.add_argument('--durability', type=durability_type, default=str(Durability()), metavar='MODE', help='fsync-each (default), fsync-batch[:blocks[:ms]] or os-buffered')
 
 # create subparsers for 'log' and 'remove' commands
 subparsers = parser.add_subparsers(dest='command')
@@ -28,9 +55,16 @@ checkin_parser.add_argument('-i', '--item_id', required=True, type=int, help=' S
 # subparser for 'log' command
 log_parser = subparsers.add_parser('log', help='Display the blockchain entries giving the oldest first (unless -r is given)')
 log_parser.add_argument('-r', '--reverse', action='store_true', help='Reverses the order of the block entries to show the most recent entries first')
-log_parser.add_argument('-n', '--num_entries', type=int, help='When used with log, shows num_entries number of block entries')
-log_parser.add_argument('-c', '--case_id', required=True, type=int, help='Specifies the case identifier that the evidence is associated with')
-log_parser.add_argument('-i', '--item_id', required=True, type=int, help=' Specifies the evidence item’s identifier')
+log_parser.add_argument('-n', '--num_entries', type=count_type, help='When used with log, shows num_entries number of block entries')
+log_parser.add_argument('-c', '--case_id', type=int, help='Specifies the case identifier that the evidence is associated with')
+log_parser.add_argument('-i', '--item_id', type=int, help=' Specifies the evidence item’s identifier')
+
+# subparser for 'export' command
+export_parser = subparsers.add_parser('export', help='Write the blockchain entries oldest first as JSONL, CSV or NumPy loadable columns')
+export_parser.add_argument('-o', '--output', default='-', help='File to write to, - for stdout')
+export_parser.add_argument('-f', '--format', choices=['jsonl', 'csv', 'columns'], help='Output format, taken from the file extension (.csv, .cols) if not given, jsonl otherwise')
+export_parser.add_argument('-c', '--case_id', type=int, help='Only export blocks of this case')
+export_parser.add_argument('-i', '--item_id', type=int, help='Only export blocks of this item')
 
 # subparser for 'remove' command
 remove_parser = subparsers.add_parser('remove', help='Prevents any further action from being taken on the evidence item specified')
@@ -40,69 +74,94 @@ remove_parser.add_argument('-o', '--owner', help=': Information about the lawful
 
 # subparser for 'init' command
 init_parser = subparsers.add_parser('init', help='init Sanity check. Only starts up and checks for the initial block')
+init_parser.add_argument('--hash', choices=list(HASHES), help=f'Block hash to link a new blockchain with, {DEFAULT_HASH} (the default) is the one the spec requires')
 
 # subparser for 'verify' command
 verify_parser = subparsers.add_parser('verify', help='Parse the blockchain and validate all entries')
-
-args = parser.parse_args()
-
-
-if args.command == "add":
-    # ex: bchoc add -c case_id -i item_id [-i item_id ...]
-    
-    # -i can have multiple uses so its output is a list i believe
-    print()
-
-elif args.command == "checkout":
-    print()
-
-elif args.command == "checkin":
-    print()
-
-elif args.command == "log":
-    print("log")
-
-
-    if args.reverse and args.num_entries:
-        # ex: bchoc log -r -n 5 -c 66 -i 2
-        print(f'Reverse order of {args.num_entries} entries')
-        # code here for reverse order of num_entries
-
-    elif args.reverse and not args.num_entries:
-        # ex: bchoc log -r -c 66 -i 2
-        print('Reverse order of all entries')
-        # code here for reverse order of all entries
-
-    elif not args.reverse and args.num_entries:
-        # ex: bchoc log -n 5 -c 66 -i 2
-        print(f'First {args.num_entries} entries')
-        # code here for first num_entries
-    
-    else:
-        # ex: bchoc log -c 66 -i 2
-        # neither reverse and all entries
-        print()
-
-
-
-elif args.command == "remove":
-    print("remove")
-
-
-    if args.owner:
-        # ex: bchoc remove -i 6 -y idk -o Chris
-        print()
+verify_mode = verify_parser.add_mutually_exclusive_group()
+verify_mode.add_argument('--incremental', action='store_true', help='Only validate blocks added since the last clean verify')
+verify_mode.add_argument('--full', action='store_true', help='Validate every block even if a checkpoint exists')
+verify_parser.add_argument('-j', '--jobs', type=int, default=1, help='Number of processes to hash the chain with')
+
+# subparser for 'import' command
+import_parser = subparsers.add_parser('import', help='Stream add, checkout, checkin and remove actions from a CSV or JSONL file')
+import_parser.add_argument('file', nargs='?', default='-', help='File to read actions from, - for stdin')
+import_parser.add_argument('-f', '--format', choices=['csv', 'jsonl'], help='Input format, taken from the file extension if not given')
+import_parser.add_argument('-b', '--batch_size', type=int, help='Number of blocks to write per append, 1000 if not given')
+
+# subparser for 'serve' command
+serve_parser = subparsers.add_parser('serve', help='Keep the chain open and run commands sent over a local socket')
+
+# subparser for 'reindex' command
+reindex_parser = subparsers.add_parser('reindex', help='Rebuild the item and case index sidecars from the blockchain')
+
+# subparser for 'status' command
+status_parser = subparsers.add_parser('status', help='Show the current state of items from the item index, without reading the blockchain')
+status_parser.add_argument('-c', '--case_id', type=int, help='Show every item of this case')
+status_parser.add_argument('-i', '--item_id', type=int, help='Show this item')
+
+# subparser for 'segments' command
+segments_parser = subparsers.add_parser('segments', help='List the sealed segments of the blockchain from its manifest')
+
+# subparser for 'prove' command
+prove_parser = subparsers.add_parser('prove', help='Print a Merkle inclusion proof for one of an item\'s blocks as JSON')
+prove_parser.add_argument('-i', '--item_id', required=True, type=int, help=' Specifies the evidence item’s identifier')
+prove_parser.add_argument('--block', required=True, type=int, help='Which of the item\'s blocks, 1 for the oldest as log -i lists them, -1 for the newest')
+
+# subparser for 'verify-proof' command
+verify_proof_parser = subparsers.add_parser('verify-proof', help='Check an inclusion proof written by prove')
+verify_proof_parser.add_argument('file', nargs='?', default='-', help='File to read the proof from, - for stdin')
+verify_proof_parser.add_argument('--root', help='Trusted Merkle root in hex, the blockchain\'s own if not given')
+
+
+# the module under commands/ that implements each subcommand. only the one
+# being dispatched gets imported, so short commands never pay for the
+# imports of the others
+COMMANDS = {
+    "add": "add",
+    "checkout": "checkout",
+    "checkin": "checkin",
+    "log": "log",
+    "export": "exporter",
+    "remove": "remove",
+    "init": "init",
+    "verify": "verify",
+    "import": "importer",
+    "serve": "serve",
+    "reindex": "reindex",
+    "status": "status",
+    "segments": "segments",
+    "prove": "prove",
+    "verify-proof": "verifyproof",
+}
+
+
+def run(args, started=None):
+    # started is the perf_counter() the process began at, for --profile to
+    # time startup from
+    if args.command not in COMMANDS:
+        #print(f"Unknown command: {args.command}")
+        sys.exit(1)
+    durability.current = args.durability
+    command = import_module(f"commands.{COMMANDS[args.command]}").run
+    if args.profile or args.profile_dump:
+        import profiling
+        profiling.run(args.command, command, args, started, args.profile_dump)
     else:
-        # ex: bchoc remove -i 6 -y idk
-        print()
+        command(args)
 
-elif args.command == "init":
-    print()
 
-elif args.command == "verify":
-    print()
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+        if env_durability is not None:
+            argv[1:1] = ["--durability", env_durability]
+    if not (profile_enabled or profile_dump):
+        status = forward(filepath_to_chain, argv)
+        if status is not None:
+            sys.exit(status)
+    run(parser.parse_args(argv))
 
-else:
-    #print(f"Unknown command: {args.command}")
-    sys.exit(1)
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from block import ChainError
+from bulkimport import ActionError, Importer
+from store import ChainStore
+from writer import ConflictError
+
+# requests the writer task takes off its queue for one append, each of them
+# is one add, checkout, checkin or remove
+MAX_BATCH = 1000
+READER_THREADS = 4
+
+
+class BlockCopy:
+    # the fields of a block copied out of the chain, so they stay valid once
+    # the snapshot it was read from is closed. same field names as
+    # block.BlockView
+    __slots__ = ("offset", "timestamp", "case_id", "item_id", "state", "data")
+
+    def __init__(self, block):
+        self.offset = block.offset
+        self.timestamp = block.timestamp
+        self.case_id = block.case_id
+        self.item_id = block.item_id
+        self.state = block.state
+        self.data = bytes(block.data)
+
+
+class AsyncChainStore:
+    # store.ChainStore for asyncio code, nothing here blocks the event loop.
+    # writes queue up for a single writer task, which checks everything that
+    # queued while the previous append was on disk against the item index
+    # and appends what passes in one write and one fsync, on a thread of its
+    # own. a request that fails its check raises ChainError without holding
+    # back the others. reads run on a pool of threads, each with its own
+    # ChainStore, and every log or verify reads one snapshot of the chain
+    #
+    #   store = await AsyncChainStore.open("chain", create=True)
+    #   try:
+    #       await asyncio.gather(store.add(66, [1]), store.add(66, [2]))
+    #       blocks = await store.log(case_id=66, reverse=True, limit=5)
+    #   finally:
+    #       await store.close()
+
+    def __init__(self, path, executor=None, max_batch=MAX_BATCH):
+        self.path = path
+        self.max_batch = max_batch
+        self._own_executor = executor is None
+        self._executor = executor or ThreadPoolExecutor(READER_THREADS, thread_name_prefix="bchoc-reader")
+        self._write_executor = ThreadPoolExecutor(1, thread_name_prefix="bchoc-writer")
+        self._write_store = None
+        self._queue = asyncio.Queue()
+        self._writer = None
+        self._closed = False
+        # one store per reader thread, every one of them is closed at the end
+        self._local = threading.local()
+        self._stores = []
+        self._stores_lock = threading.Lock()
+
+    @classmethod
+    async def open(cls, path, create=False, executor=None, max_batch=MAX_BATCH):
+        # executor runs the reads, a thread pool of READER_THREADS if None
+        store = cls(path, executor, max_batch)
+        loop = asyncio.get_running_loop()
+        try:
+            store._write_store = await loop.run_in_executor(store._write_executor, ChainStore.open, path, create)
+        except BaseException:
+            store._shutdown()
+            raise
+        store._writer = asyncio.create_task(store._write_loop())
+        return store
+
+    async def add(self, case_id, item_ids):
+        # returns the timestamps of the new blocks
+        item_ids = list(item_ids)
+        if len(set(item_ids)) != len(item_ids):
+            raise ChainError("the same item id was given more than once")
+        results = await self._submit([{"action": "add", "case_id": case_id, "item_id": item_id}
+                                      for item_id in item_ids])
+        return [timestamp for _, timestamp in results]
+
+    async def checkout(self, item_id):
+        # returns (case id, timestamp), like the rest
+        return (await self._submit([{"action": "checkout", "item_id": item_id}]))[0]
+
+    async def checkin(self, item_id):
+        return (await self._submit([{"action": "checkin", "item_id": item_id}]))[0]
+
+    async def remove(self, item_id, reason, owner=None):
+        action = {"action": "remove", "item_id": item_id, "reason": reason, "owner": owner}
+        return (await self._submit([action]))[0]
+
+    async def _submit(self, actions):
+        if self._closed:
+            raise ChainError("the store is closed")
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((actions, future))
+        return await future
+
+    async def _write_loop(self):
+        loop = asyncio.get_running_loop()
+        closing = False
+        while not closing:
+            request = await self._queue.get()
+            if request is None:
+                break
+            batch = [request]
+            while len(batch) < self.max_batch and not self._queue.empty():
+                request = self._queue.get_nowait()
+                if request is None:
+                    closing = True
+                    break
+                batch.append(request)
+            try:
+                results = await loop.run_in_executor(self._write_executor, self._write_batch,
+                                                     [actions for actions, _ in batch])
+            except Exception as e:
+                results = [e] * len(batch)
+            for (_, future), result in zip(batch, results):
+                if future.done():
+                    # the caller was cancelled, its blocks are written all the same
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    def _write_batch(self, requests):
+        # runs on the writer thread. returns a list of (case id, timestamp)
+        # per request, or the ChainError it failed with. another process
+        # can still get in between the check and the append, then the whole
+        # batch is checked again once
+        try:
+            return self._check_and_write(requests)
+        except ConflictError:
+            return self._check_and_write(requests)
+
+    def _check_and_write(self, requests):
+        store = self._write_store
+        store.refresh()
+        importer = Importer(self.path, store.indexes, sum(map(len, requests)) + 1)
+        spans = []
+        for actions in requests:
+            start = len(importer.records)
+            try:
+                for action in actions:
+                    importer.apply(action)
+            except ActionError as e:
+                # an add of several items goes in whole or not at all
+                importer.undo(start)
+                spans.append(e)
+            else:
+                spans.append((start, len(importer.records)))
+        records = importer.records
+        timestamps = importer.flush()
+        results = []
+        for span in spans:
+            if isinstance(span, Exception):
+                results.append(span)
+            else:
+                start, end = span
+                results.append([(record[0], timestamp)
+                                for record, timestamp in zip(records[start:end], timestamps[start:end])])
+        return results
+
+    def _reader_store(self):
+        store = getattr(self._local, "store", None)
+        if store is None:
+            store = self._local.store = ChainStore.open(self.path)
+            with self._stores_lock:
+                self._stores.append(store)
+        return store
+
+    async def _read(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def lookup(self, item_id):
+        # (case id, state) of an item, None if it was never added
+        return await self._read(self._lookup, item_id)
+
+    def _lookup(self, item_id):
+        return self._reader_store().lookup(item_id)
+
+    async def log(self, case_id=None, item_id=None, reverse=False, limit=None):
+        # a list of BlockCopy, see ChainStore.iter_log. without a limit the
+        # whole matching log is held in memory
+        return await self._read(self._log, case_id, item_id, reverse, limit)
+
+    def _log(self, case_id, item_id, reverse, limit):
+        return [BlockCopy(block) for block in self._reader_store().iter_log(case_id, item_id, reverse, limit)]
+
+    async def verify(self, incremental=False, jobs=1):
+        # returns the verify.ChainVerifier, see ChainStore.verify
+        return await self._read(self._verify, incremental, jobs)
+
+    def _verify(self, incremental, jobs):
+        return self._reader_store().verify(incremental, jobs)
+
+    async def close(self):
+        # waits for the writes already queued, then closes every store
+        if self._closed:
+            return
+        self._closed = True
+        if self._writer is not None:
+            await self._queue.put(None)
+            await self._writer
+        await asyncio.get_running_loop().run_in_executor(None, self._shutdown)
+
+    def _shutdown(self):
+        self._write_executor.shutdown()
+        if self._own_executor:
+            self._executor.shutdown()
+        if self._write_store is not None:
+            self._write_store.close()
+        for store in self._stores:
+            store.close()
+        self._stores = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
@@ -2,6 +2,10 @@
 
 import os
 import sys
+import time
+
+# taken first thing so --profile can time startup
+started = time.perf_counter()
 
 env_path = os.environ.get("BCHOH_FILE_PATH")
 
@@ -10,13 +14,35 @@ if env_path is None:
 else:
     filepath_to_chain = env_path
 
-print(filepath_to_chain)
+# BCHOH_PROFILE=1 profiles every call as if --profile were given, and
+# BCHOH_PROFILE_DUMP=<file> also writes cProfile stats there
+profile_enabled = os.environ.get("BCHOH_PROFILE", "") not in ("", "0")
+profile_dump = os.environ.get("BCHOH_PROFILE_DUMP") or None
 
-num_args = len(sys.argv)
+# BCHOH_DURABILITY=<mode> sets --durability for every call, see durability.py
+env_durability = os.environ.get("BCHOH_DURABILITY") or None
 
-if num_args <= 1:
-    print("Error: must provide args at command line")
-    exit(1)
-else:
-    command = sys.argv[1]
-    print(command)
+if __name__ == "__main__":
+    num_args = len(sys.argv)
+
+    if num_args <= 1:
+        print("Error: must provide args at command line")
+        exit(1)
+    else:
+        # the parser expects the program name first, like argtest.py bchoc ...
+        argv = ["bchoc"] + sys.argv[1:]
+        if env_durability is not None:
+            # as an option so it reaches the daemon too, one given on the
+            # command line comes later and wins
+            argv[1:1] = ["--durability", env_durability]
+
+        # hand the call to a running daemon before paying for the parser.
+        # a profiled call has to run here to be measured
+        if not (profile_enabled or profile_dump):
+            from client import forward
+            status = forward(filepath_to_chain, argv)
+            if status is not None:
+                exit(status)
+
+        from argtest import parser, run
+        run(parser.parse_args(argv), started)
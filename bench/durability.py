@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+# cost of an append under each durability mode (see durability.py).
+#
+# appends --appends single block batches to a scratch chain in one process,
+# the way a stream of adds and checkouts through the daemon would, once per
+# mode, and prints the time per append. the scratch chain goes in --dir so
+# it can be pointed at the disk that matters, /tmp is often a ram disk
+#
+#   python bench/durability.py
+#   python bench/durability.py --appends 5000 --dir /data/scratch
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import durability  # noqa: E402
+from durability import Durability  # noqa: E402
+from store import INDEX_TYPES  # noqa: E402
+from writer import append_block, create_chain, sync_chain  # noqa: E402
+
+MODES = ("fsync-each", "fsync-batch", "os-buffered")
+
+
+def time_mode(directory, mode, appends):
+    # seconds per append, the final sync included
+    with tempfile.TemporaryDirectory(dir=directory) as tmp:
+        path = os.path.join(tmp, "chain")
+        create_chain(path)
+        indexes = tuple(index_type.open(path) for index_type in INDEX_TYPES)
+        durability.current = Durability.parse(mode)
+        start = time.perf_counter()
+        for item_id in range(appends):
+            append_block(path, indexes, 1, item_id, "CHECKEDIN", expected=None)
+        sync_chain(path, indexes)
+        elapsed = time.perf_counter() - start
+        for index in indexes:
+            index.close()
+    durability.current = Durability()
+    return elapsed / appends
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time appends under each durability mode")
+    parser.add_argument("--appends", type=int, default=2000)
+    parser.add_argument("--dir", help="Directory for the scratch chain, the system temp dir if not given")
+    opts = parser.parse_args()
+
+    print("mode            ms / append   appends / s")
+    for mode in MODES:
+        seconds = time_mode(opts.dir, mode, opts.appends)
+        print(f"{mode:<15} {seconds * 1000:11.3f}   {1 / seconds:11.0f}")
+
+
+if __name__ == "__main__":
+    main()
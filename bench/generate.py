@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+# deterministic synthetic chain generator for benchmarks.
+#
+# the same --blocks and --seed always give the same chain, timestamps
+# included. case sizes follow a zipf like curve so a handful of cases hold
+# most of the evidence, and once items exist most blocks are checkouts and
+# checkins of them with the odd removal, roughly what a busy lab looks like.
+# the sidecar indexes and tail trailer are built afterwards so the chain is
+# ready for the cli.
+#
+#   python bench/generate.py /tmp/chain --blocks 1000000
+
+import argparse
+import os
+import random
+import sys
+import time
+from itertools import accumulate
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from block import REMOVED_STATES, block_hash, genesis_block, pack_block  # noqa: E402
+from store import INDEX_TYPES  # noqa: E402
+from writer import save_tail  # noqa: E402
+
+SIZES = {"10k": 10000, "1m": 1000000, "10m": 10000000}
+
+# share of blocks after the first few that add a new item, the rest act on
+# an existing one
+ADD_RATE = 0.3
+REMOVE_RATE = 0.02
+CASES = 5000
+START_TIME = 1.6e9
+# ids handed out by the generator stay below this so benchmarks can add
+# their own items above it
+FIRST_FREE_ITEM = 1 << 30
+
+
+def generate(path, blocks, seed=469):
+    # writes the chain and returns a summary with what benchmarks need to
+    # know about it
+    rng = random.Random(seed)
+    # zipf like weights, case n is picked about 1/n as often as case 1
+    case_ids = [rng.getrandbits(64) for _ in range(CASES)]
+    cum_weights = list(accumulate(1 / (n + 1) for n in range(CASES)))
+
+    # items that can still be acted on, with their case and state. swapping
+    # removed items out of the list keeps picks O(1)
+    live = []
+    live_case = {}
+    live_state = {}
+    next_item = 1
+    timestamp = START_TIME
+
+    with open(path, "wb") as f:
+        # stamped like the rest so a seed always gives the same chain
+        raw = genesis_block(timestamp=timestamp)
+        f.write(raw)
+        offset = len(raw)
+        last_offset = 0
+        prev_hash = block_hash(raw)
+        chunk = []
+
+        for _ in range(blocks - 1):
+            timestamp += rng.expovariate(1 / 30)
+            if not live or rng.random() < ADD_RATE:
+                item_id = next_item
+                next_item += 1
+                case_id = rng.choices(case_ids, cum_weights=cum_weights)[0]
+                live.append(item_id)
+                live_case[item_id] = case_id
+                state = "CHECKEDIN"
+                data = b""
+            else:
+                pos = rng.randrange(len(live))
+                item_id = live[pos]
+                case_id = live_case[item_id]
+                data = b""
+                if live_state[item_id] == "CHECKEDOUT":
+                    state = "CHECKEDIN"
+                elif rng.random() < REMOVE_RATE:
+                    state = rng.choice(REMOVED_STATES)
+                    if state == "RELEASED":
+                        data = b"Owner\0"
+                    live[pos] = live[-1]
+                    live.pop()
+                    del live_case[item_id]
+                    del live_state[item_id]
+                else:
+                    state = "CHECKEDOUT"
+            if state not in REMOVED_STATES:
+                live_state[item_id] = state
+
+            raw = pack_block(prev_hash, case_id, item_id, state, data, timestamp)
+            chunk.append(raw)
+            prev_hash = block_hash(raw)
+            last_offset = offset
+            offset += len(raw)
+            if len(chunk) >= 10000:
+                f.write(b"".join(chunk))
+                chunk = []
+        f.write(b"".join(chunk))
+
+    save_tail(path, last_offset, prev_hash, os.stat(path))
+    # rebuild rather than open, sidecars left from an older chain at the
+    # same path could otherwise look current
+    for index_type in INDEX_TYPES:
+        index = index_type(path)
+        index.rebuild()
+        index.close()
+
+    return {
+        "blocks": blocks,
+        "bytes": offset,
+        "items": next_item - 1,
+        "seed": seed,
+        "busiest_case": case_ids[0],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write a deterministic synthetic chain")
+    parser.add_argument("path", help="Chain file to write, replaced if it exists")
+    size = parser.add_mutually_exclusive_group()
+    size.add_argument("--blocks", type=int, default=SIZES["10k"], help="Number of blocks, genesis included")
+    size.add_argument("--size", choices=sorted(SIZES), help="One of the standard sizes")
+    parser.add_argument("--seed", type=int, default=469)
+    opts = parser.parse_args()
+
+    blocks = SIZES[opts.size] if opts.size else opts.blocks
+    start = time.perf_counter()
+    summary = generate(opts.path, blocks, opts.seed)
+    print(f"wrote {summary['blocks']} blocks, {summary['bytes']} bytes, {summary['items']} items "
+          f"in {time.perf_counter() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
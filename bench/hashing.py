@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+# speed of the block hashes a chain can be linked with (block.HASHES) over
+# a range of block sizes.
+#
+# builds --blocks blocks of each data size back to back in one buffer, the
+# way they sit in a mapped chain, and hashes every one through a memoryview
+# slice the way verify and appends do. the default data sizes are an add
+# or checkout (none), a release with a short owner and a few larger ones
+#
+#   python bench/hashing.py
+#   python bench/hashing.py --blocks 500000 --sizes 0 14 1024
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from block import HASHES, HEADER_SIZE, NULL_HASH, pack_block  # noqa: E402
+
+SIZES = (0, 14, 256, 4096, 65536)
+# data beyond this many bytes in total cuts --blocks down, so the large
+# sizes do not need gigabytes
+MAX_BYTES = 256 << 20
+
+
+def chain_buffer(data_size, blocks):
+    # blocks of data_size bytes of data in a row, and the size of each
+    raw = pack_block(NULL_HASH, 1, 1, "CHECKEDIN", bytes(data_size), 0.0)
+    return memoryview(raw * blocks), len(raw)
+
+
+def time_hash(block_hash, buf, size, repeat):
+    # best of repeat passes, in seconds per block
+    blocks = len(buf) // size
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for offset in range(0, len(buf), size):
+            block_hash(buf[offset:offset + size])
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / blocks
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the block hashes over block sizes")
+    parser.add_argument("--blocks", type=int, default=200000, help="Blocks hashed per size")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES, help="Data field sizes in bytes")
+    parser.add_argument("--repeat", type=int, default=3, help="Passes per hash and size, the best is kept")
+    opts = parser.parse_args()
+
+    names = list(HASHES)
+    print(f"{'block bytes':>12}" + "".join(f"{name + ' ns':>14}{name + ' MB/s':>16}" for name in names))
+    for data_size in opts.sizes:
+        size = HEADER_SIZE + data_size
+        buf, size = chain_buffer(data_size, max(1, min(opts.blocks, MAX_BYTES // size)))
+        row = f"{size:>12}"
+        for name in names:
+            per_block = time_hash(HASHES[name], buf, size, opts.repeat)
+            row += f"{per_block * 1e9:>14.0f}{size / per_block / 1e6:>16.0f}"
+        print(row)
+        buf.release()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+# accuracy and speed of the item filter (index.ItemFilter) at tens of
+# millions of items, against the item index it saves a lookup in.
+#
+# fills a filter with --items distinct ids at the most items per slot it
+# ever holds before it grows, the worst case, then checks that every id
+# that went in is still a "maybe" and counts how many of --probes ids that
+# never went in are a "maybe" anyway. fails on any false negative.
+#
+# it also fills an item index with the same ids and times a miss in it,
+# once warm and once cold, with the index dropped from the page cache the
+# way it is at this size once the chain has been busy with other items.
+# an add's check costs a filter check plus, for a "maybe", an index
+# lookup. the filter is only asked once the index is past
+# FILTER_MIN_INDEX_BYTES (ItemIndex.filtered). fails if at this size that
+# picks the slower of the two: the filter while it is not cheaper than
+# the cold index, or the warm index alone while the filter beats it by
+# more than MARGIN. below the threshold the two are within a few percent
+# of each other
+#
+#   python bench/itemfilter.py
+#   python bench/itemfilter.py --items 50000000 --dir /data/scratch
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from index import (FILTER_ITEMS_PER_SLOT, INITIAL_CAPACITY, MAX_LOAD, STATE_CODES, ItemFilter,  # noqa: E402
+                   ItemIndex)
+
+# spreads 0, 1, 2, ... over the 32 bit item ids without repeating
+SPREAD = 2654435761
+
+# how much faster the filter has to be than the warm index to be worth
+# checking below the threshold
+MARGIN = 1.1
+
+
+def item_ids(start, stop):
+    return ((i * SPREAD) & 0xFFFFFFFF for i in range(start, stop))
+
+
+def time_checks(table, ids, repeat=5):
+    # seconds per membership check, the best of repeat passes so a busy
+    # machine does not decide which side wins
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for item_id in ids:
+            item_id in table
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(ids)
+
+
+def evict(path):
+    # drop a file from the page cache, its dirty pages are written first
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the item filter's false positives and its speed against the item index")
+    parser.add_argument("--items", type=int, default=20000000, help="Item ids in the filter")
+    parser.add_argument("--probes", type=int, default=1000000, help="Ids never added to check")
+    parser.add_argument("--cold-probes", type=int, default=20000, help="Ids never added to look up in the cold index")
+    parser.add_argument("--dir", help="Directory for the scratch files, the system temp dir if not given")
+    opts = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=opts.dir) as tmp:
+        chain_path = os.path.join(tmp, "chain")
+        item_filter = ItemFilter(chain_path)
+        slots = -(-opts.items // FILTER_ITEMS_PER_SLOT)
+        item_filter._create(slots)
+
+        start = time.perf_counter()
+        for item_id in item_ids(0, opts.items):
+            item_filter.add(item_id)
+        build = time.perf_counter() - start
+
+        sample = min(opts.items, opts.probes)
+        missed = sum(1 for item_id in item_ids(0, sample) if item_id not in item_filter)
+
+        probes = list(item_ids(opts.items, opts.items + opts.probes))
+        maybes = sum(1 for item_id in probes if item_id in item_filter)
+        check = time_checks(item_filter, probes)
+        size = os.path.getsize(item_filter.path)
+        item_filter.close()
+
+        # sized up front to what it grows to, the slots are all that is timed
+        capacity = INITIAL_CAPACITY
+        while opts.items > capacity * MAX_LOAD:
+            capacity *= 2
+        item_index = ItemIndex(chain_path)
+        item_index._create(capacity)
+        state = STATE_CODES["CHECKEDIN"]
+        case_id = bytes(16)
+        for item_id in item_ids(0, opts.items):
+            item_index._store(item_id, state, 0, case_id, 0)
+        item_index.commit(0)
+        index_size = os.path.getsize(item_index.path)
+        filtered = item_index.filtered
+        cold_probes = probes[:opts.cold_probes]
+        warm = time_checks(item_index, cold_probes)
+        item_index.close()
+        evict(item_index.path)
+        item_index = ItemIndex(chain_path)
+        item_index._map_file()
+        # a second pass would find it warm
+        cold = time_checks(item_index, cold_probes, repeat=1)
+        item_index.close()
+
+    with_filter = check + maybes / opts.probes * cold
+    warm_filter = check + maybes / opts.probes * warm
+    print(f"items              {opts.items}")
+    print(f"filter size        {size / 2**20:.1f} MB, {size * 8 / opts.items:.1f} bits per item")
+    print(f"build              {build:.1f} s, {build / opts.items * 1e9:.0f} ns per add")
+    print(f"false negatives    {missed} of {sample}")
+    print(f"false positives    {maybes} of {opts.probes}, {maybes / opts.probes:.2%}")
+    print(f"check              {check * 1e9:.0f} ns per id")
+    print(f"index size         {index_size / 2**20:.1f} MB")
+    print(f"index miss, warm   {warm * 1e9:.0f} ns per id")
+    print(f"index miss, cold   {cold * 1e9:.0f} ns per id")
+    print(f"new id, filtered   {with_filter * 1e9:.0f} ns per id, filter and the cold index for a maybe")
+    print(f"new id, warm       {warm_filter * 1e9:.0f} ns per id, filter and the warm index for a maybe")
+    print(f"filter checked     {'yes' if filtered else 'no'}, index {'past' if filtered else 'under'} the threshold")
+    if missed:
+        sys.exit(1)
+    if filtered and with_filter >= cold or not filtered and warm_filter * MARGIN < warm:
+        print("the threshold picks the slower path at this size")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+# memory per block of the in memory chain model (columns.ChainColumns).
+#
+# builds a synthetic chain, loads it into columns under tracemalloc and
+# fails if the memory held per block goes over columns.MAX_BYTES_PER_BLOCK.
+#
+#   python bench/memory.py
+#   python bench/memory.py --blocks 1000000
+
+import argparse
+import os
+import random
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from block import BlockReader, block_hash, genesis_block, pack_block  # noqa: E402
+from columns import BYTES_PER_BLOCK, MAX_BYTES_PER_BLOCK, ChainColumns  # noqa: E402
+
+
+def write_chain(path, blocks):
+    rng = random.Random(469)
+    with open(path, "wb") as f:
+        raw = genesis_block()
+        f.write(raw)
+        prev_hash = block_hash(raw)
+        for i in range(blocks - 1):
+            raw = pack_block(prev_hash, rng.getrandbits(128), i, "CHECKEDIN", timestamp=1e9 + i)
+            f.write(raw)
+            prev_hash = block_hash(raw)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the memory per block of ChainColumns")
+    parser.add_argument("--blocks", type=int, default=200000, help="Blocks in the synthetic chain")
+    opts = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "chain")
+        write_chain(path, opts.blocks)
+        with BlockReader(path) as reader:
+            tracemalloc.start()
+            before = tracemalloc.get_traced_memory()[0]
+            # loaded the way Store.keep_columns loads them
+            columns = ChainColumns()
+            columns.extend(reader)
+            held = tracemalloc.get_traced_memory()[0] - before
+            tracemalloc.stop()
+
+    per_block = held / len(columns)
+    reserved = columns.nbytes() / len(columns)
+    print(f"blocks            {len(columns)}")
+    print(f"field bytes       {BYTES_PER_BLOCK}")
+    print(f"held per block    {per_block:.1f}")
+    print(f"reserved / block  {reserved:.1f}")
+    print(f"limit             {MAX_BYTES_PER_BLOCK}")
+    if per_block > MAX_BYTES_PER_BLOCK:
+        print("OVER LIMIT")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
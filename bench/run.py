@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+# end to end benchmark of every cli command against a synthetic chain.
+#
+# generates a chain with bench/generate.py (or reuses one), then runs each
+# command through bchoc.py as a user would, interpreter start included,
+# --runs times. results go out as json so releases can be compared:
+#
+#   python bench/run.py --size 1m --output results-1m.json
+#   python bench/run.py --chain /data/bench/chain --runs 3
+#
+# every run adds fresh items above generate.FIRST_FREE_ITEM, so a reused
+# chain keeps growing by a little over 100 blocks per run
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from generate import FIRST_FREE_ITEM, SIZES, generate  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BCHOC = os.path.join(ROOT, "bchoc.py")
+BATCH = 100
+
+
+def time_command(args, env):
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, BCHOC] + args, env=env, capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    if result.returncode != 0:
+        raise SystemExit(f"bchoc {' '.join(args)} failed:\n{result.stdout}{result.stderr}")
+    return elapsed
+
+
+def steps(run, summary, opts):
+    # (name, args) in the order they run, each run uses its own items
+    item = FIRST_FREE_ITEM + run * (BATCH + 1)
+    batch = [str(item + 1 + i) for i in range(BATCH)]
+    case = str(summary["busiest_case"])
+    yield "init", ["init"]
+    yield "add", ["add", "-c", case, "-i", str(item)]
+    yield "add_batch", ["add", "-c", case, "-i"] + batch
+    yield "checkout", ["checkout", "-i", str(item)]
+    yield "checkin", ["checkin", "-i", str(item)]
+    yield "log", ["log"] if opts.full_log else ["log", "-i", str(item)]
+    yield "log_n", ["log", "-n", "10"]
+    yield "log_r", ["log", "-r"] if opts.full_log else ["log", "-r", "-i", str(item)]
+    yield "log_r_n", ["log", "-r", "-n", "10"]
+    yield "log_case", ["log", "-c", case, "-r", "-n", "10"]
+    yield "remove", ["remove", "-i", str(item), "-y", "DISPOSED"]
+    if not opts.skip_verify:
+        yield "verify", ["verify"]
+        yield "verify_incremental", ["verify", "--incremental"]
+        if opts.jobs > 1:
+            yield "verify_jobs", ["verify", "-j", str(opts.jobs)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time every bchoc command against a synthetic chain")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--size", choices=sorted(SIZES), default="10k", help="Size of the chain to generate")
+    source.add_argument("--chain", help="Use this existing chain instead of generating one")
+    parser.add_argument("--case", type=int, help="Case id to add into and log, with --chain")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1, help="Processes for the verify -j run")
+    parser.add_argument("--skip-verify", action="store_true", help="Leave out verify, it reads the whole chain")
+    parser.add_argument("--full-log", action="store_true",
+                        help="Time log and log -r over the whole chain instead of one item")
+    parser.add_argument("--output", help="Write the json here instead of stdout")
+    opts = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    try:
+        if opts.chain:
+            path = opts.chain
+            summary = {"blocks": None, "bytes": os.path.getsize(path), "busiest_case": opts.case or 0}
+        else:
+            path = os.path.join(tmp, "chain")
+            start = time.perf_counter()
+            summary = generate(path, SIZES[opts.size])
+            summary["generate_seconds"] = time.perf_counter() - start
+        env = dict(os.environ, BCHOH_FILE_PATH=path)
+
+        timings = {}
+        for run in range(opts.runs):
+            for name, args in steps(run, summary, opts):
+                timings.setdefault(name, {"args": args, "seconds": []})["seconds"].append(time_command(args, env))
+    finally:
+        shutil.rmtree(tmp)
+
+    results = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "chain": summary,
+        "runs": opts.runs,
+        "commands": {
+            name: {
+                "args": timing["args"],
+                "min_ms": min(timing["seconds"]) * 1000,
+                "median_ms": statistics.median(timing["seconds"]) * 1000,
+                "max_ms": max(timing["seconds"]) * 1000,
+            }
+            for name, timing in timings.items()
+        },
+    }
+    if opts.output:
+        with open(opts.output, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+# cold start budget for the short commands.
+#
+# runs each command under `python -X importtime` against a scratch chain
+# and fails if the time spent importing goes over its budget, or if the
+# command pulls in a module it has no business loading. the best of
+# --runs is compared so one slow run does not fail the check.
+#
+#   python bench/startup.py
+#   python bench/startup.py --runs 10 --scale 2    (slower machine)
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BCHOC = os.path.join(ROOT, "bchoc.py")
+
+# microseconds of import time, all modules included
+BUDGETS_US = {
+    "init": 75000,
+    "add": 75000,
+    "checkout": 75000,
+    "checkin": 75000,
+    "log": 75000,
+}
+
+# modules only the heavier commands need. none of the commands timed here
+# should ever import one of them
+FORBIDDEN = {
+    "concurrent.futures",
+    "csv",
+    "json",
+    "selectors",
+    "bulkimport",
+    "daemon",
+    "verify",
+}
+
+
+def import_times(args, env):
+    # (total import time in us, names of every module imported)
+    result = subprocess.run([sys.executable, "-X", "importtime", BCHOC] + args,
+                            env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise SystemExit(f"bchoc {' '.join(args)} failed:\n{result.stdout}{result.stderr}")
+    total = 0
+    modules = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        modules.add(name.strip())
+        # only top level imports, nested ones are already in their parent's total
+        if not name[1:].startswith(" "):
+            total += int(cumulative)
+    return total, modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check bchoc cold start against its import time budget")
+    parser.add_argument("--runs", type=int, default=5, help="Runs per command, the fastest is compared")
+    parser.add_argument("--scale", type=float, default=1.0, help="Multiply every budget by this")
+    opts = parser.parse_args()
+
+    failed = False
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ, BCHOH_FILE_PATH=os.path.join(tmp, "chain"))
+        best = {command: None for command in BUDGETS_US}
+        loaded = {command: set() for command in BUDGETS_US}
+
+        for run in range(opts.runs):
+            item = 1000 + run
+            steps = [
+                ("init", ["init"]),
+                ("add", ["add", "-c", "1", "-i", str(item)]),
+                ("checkout", ["checkout", "-i", str(item)]),
+                ("checkin", ["checkin", "-i", str(item)]),
+                ("log", ["log", "-r", "-n", "1"]),
+            ]
+            for command, args in steps:
+                total, modules = import_times(args, env)
+                if best[command] is None or total < best[command]:
+                    best[command] = total
+                loaded[command] |= modules
+
+        print(f"{'command':<10} {'imports ms':>10} {'budget ms':>10}")
+        for command, budget in BUDGETS_US.items():
+            budget *= opts.scale
+            status = "ok"
+            if best[command] > budget:
+                status = "OVER BUDGET"
+                failed = True
+            print(f"{command:<10} {best[command] / 1000:>10.1f} {budget / 1000:>10.1f}  {status}")
+            bad = sorted(FORBIDDEN & loaded[command])
+            if bad:
+                print(f"  {command} imported {', '.join(bad)}")
+                failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,356 @@
+import hashlib
+import mmap
+import os
+import struct
+import time
+
+import profiling
+
+
+# block layout from the chain of custody spec (all little endian):
+#   0x00  32s  previous hash (of the whole parent block, see HASHES)
+#   0x20  d    timestamp (unix time as a float)
+#   0x28  16s  case id (stored as an integer)
+#   0x38  I    evidence item id
+#   0x3c  12s  state, null padded
+#   0x48  I    data length
+#   0x4c       data
+HEADER_FORMAT = "<32s d 16s I 12s I"
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+
+PREV_HASH_OFFSET = 0
+TIMESTAMP_OFFSET = 32
+CASE_ID_OFFSET = 40
+ITEM_ID_OFFSET = 56
+STATE_OFFSET = 60
+DATA_LENGTH_OFFSET = 72
+
+HASH_SIZE = 32
+CASE_ID_SIZE = 16
+STATE_SIZE = 12
+
+# ids a block can hold, an item id is a 4 byte and a case id a 16 byte
+# unsigned integer
+ITEM_ID_LIMIT = 1 << 32
+CASE_ID_LIMIT = 1 << (8 * CASE_ID_SIZE)
+
+STATES = ("INITIAL", "CHECKEDIN", "CHECKEDOUT", "DISPOSED", "DESTROYED", "RELEASED")
+REMOVED_STATES = ("DISPOSED", "DESTROYED", "RELEASED")
+
+GENESIS_DATA = b"Initial block\0"
+NULL_HASH = bytes(HASH_SIZE)
+
+# a chain picks its block hash (see HASHES) when it is created and names
+# it in its INITIAL block's data after GENESIS_DATA, as b"hash=<name>\0". a
+# chain with nothing there is sha256, so the spec's INITIAL block is
+# unchanged
+DEFAULT_HASH = "sha256"
+_HASH_TAG = b"hash="
+
+_double = struct.Struct("<d")
+_uint = struct.Struct("<I")
+# timestamp, case id, item id and state, the fields log prints, which sit
+# next to each other from TIMESTAMP_OFFSET
+_LOG_FIELDS = struct.Struct("<d 16s I 12s")
+
+# blocks BlockDecoder takes at once, and the distinct case ids and states
+# it keeps decoded before it starts over
+DECODE_BATCH = 256
+DECODE_CACHE_SIZE = 65536
+
+
+class ChainError(Exception):
+    pass
+
+
+def block_hash(raw):
+    # the default hash. raw can be bytes or a memoryview into the chain,
+    # hashlib reads either without copying
+    return hashlib.sha256(raw).digest()
+
+
+def _blake2b(raw):
+    return hashlib.blake2b(raw, digest_size=HASH_SIZE).digest()
+
+
+# block hash functions a chain can be linked with, all with HASH_SIZE byte
+# digests so the block layout stays the same. sha256 is the spec's.
+# blake2b is faster on cpus without sha instructions, slower on ones with
+# them, bench/hashing.py shows which this machine is
+HASHES = {"sha256": block_hash, "blake2b": _blake2b}
+
+
+def hash_name(genesis_data):
+    # the name of the hash a chain is linked with, from its INITIAL block's data
+    tag = genesis_data[len(GENESIS_DATA):].rstrip(b"\0")
+    if not genesis_data.startswith(GENESIS_DATA) or not tag.startswith(_HASH_TAG):
+        return DEFAULT_HASH
+    name = tag[len(_HASH_TAG):].decode(errors="replace")
+    if name not in HASHES:
+        raise ChainError(f"the chain is linked with {name}, which is not one of {', '.join(HASHES)}")
+    return name
+
+
+def chain_hash_name(fd):
+    # the block hash of the chain open as fd, read from its INITIAL block.
+    # an empty chain gets the default
+    header = os.pread(fd, HEADER_SIZE, 0)
+    if len(header) < HEADER_SIZE:
+        return DEFAULT_HASH
+    length = _uint.unpack_from(header, DATA_LENGTH_OFFSET)[0]
+    return hash_name(os.pread(fd, length, HEADER_SIZE))
+
+
+def chain_hash(fd):
+    return HASHES[chain_hash_name(fd)]
+
+
+def pack_block(prev_hash, case_id, item_id, state, data=b"", timestamp=None):
+    if timestamp is None:
+        timestamp = time.time()
+    header = struct.pack(HEADER_FORMAT, prev_hash, timestamp, case_id.to_bytes(CASE_ID_SIZE, "little"),
+                         item_id, state.encode(), len(data))
+    return header + data
+
+
+def genesis_block(algorithm=DEFAULT_HASH, timestamp=None):
+    if algorithm not in HASHES:
+        raise ChainError(f"unknown block hash {algorithm}, use one of {', '.join(HASHES)}")
+    data = GENESIS_DATA
+    if algorithm != DEFAULT_HASH:
+        data += _HASH_TAG + algorithm.encode() + b"\0"
+    return pack_block(NULL_HASH, 0, 0, "INITIAL", data, timestamp)
+
+
+def item_key(item_id):
+    # an item id the way it is stored in a block
+    return _uint.pack(item_id)
+
+
+class BlockDecoder:
+    # the fields log prints of many blocks at once, (case id, item id,
+    # state, timestamp) per block. a block in a mapped chain has all four
+    # read with one unpack, and since most blocks share their case and
+    # state with many others each distinct raw case id and state is only
+    # decoded the first time it is seen. anything that is not a BlockView,
+    # a columns.BlockRow say, is read through its attributes
+    def __init__(self):
+        self._cases = {}
+        self._states = {}
+
+    def decode(self, blocks):
+        cases = self._cases
+        states = self._states
+        if len(cases) > DECODE_CACHE_SIZE or len(states) > DECODE_CACHE_SIZE:
+            cases.clear()
+            states.clear()
+        unpack = _LOG_FIELDS.unpack_from
+        rows = []
+        for block in blocks:
+            if type(block) is not BlockView:
+                rows.append((block.case_id, block.item_id, block.state, block.timestamp))
+                continue
+            timestamp, raw_case, item_id, raw_state = unpack(block._buf, block.offset + TIMESTAMP_OFFSET)
+            case_id = cases.get(raw_case)
+            if case_id is None:
+                case_id = cases[raw_case] = int.from_bytes(raw_case, "little")
+            state = states.get(raw_state)
+            if state is None:
+                state = states[raw_state] = raw_state.rstrip(b"\0").decode(errors="replace")
+            rows.append((case_id, item_id, state, timestamp))
+        return rows
+
+    def iter_decoded(self, blocks):
+        # the rows of blocks, decoded DECODE_BATCH at a time. the reader
+        # they come from has to stay open until they have all been taken
+        batch = []
+        try:
+            for block in blocks:
+                batch.append(block)
+                if len(batch) == DECODE_BATCH:
+                    yield from self.decode(batch)
+                    batch = []
+        except ChainError:
+            # the blocks read before a truncated one still come out
+            yield from self.decode(batch)
+            raise
+        yield from self.decode(batch)
+
+
+class BlockView:
+    # a block inside a BlockReader's mapping. nothing is decoded up front,
+    # each field is read from the mapping only when it is asked for and the
+    # byte fields come back as memoryviews, not copies. views are only valid
+    # while the reader is open, use bytes(...) to keep a field around longer.
+    # hash() uses the hash function of the chain the view is in
+    __slots__ = ("_buf", "offset", "_hash")
+
+    def __init__(self, buf, offset, hash_function=block_hash):
+        self._buf = buf
+        self.offset = offset
+        self._hash = hash_function
+
+    @property
+    def prev_hash(self):
+        start = self.offset + PREV_HASH_OFFSET
+        return self._buf[start:start + HASH_SIZE]
+
+    @property
+    def timestamp(self):
+        return _double.unpack_from(self._buf, self.offset + TIMESTAMP_OFFSET)[0]
+
+    @property
+    def case_id_bytes(self):
+        start = self.offset + CASE_ID_OFFSET
+        return self._buf[start:start + CASE_ID_SIZE]
+
+    @property
+    def case_id(self):
+        return int.from_bytes(self.case_id_bytes, "little")
+
+    @property
+    def item_id(self):
+        return _uint.unpack_from(self._buf, self.offset + ITEM_ID_OFFSET)[0]
+
+    @property
+    def state_bytes(self):
+        start = self.offset + STATE_OFFSET
+        return self._buf[start:start + STATE_SIZE]
+
+    @property
+    def state(self):
+        # a state field that is not text comes back with replacement
+        # characters, which verify then reports like any other bad state
+        return bytes(self.state_bytes).rstrip(b"\0").decode(errors="replace")
+
+    @property
+    def data_length(self):
+        return _uint.unpack_from(self._buf, self.offset + DATA_LENGTH_OFFSET)[0]
+
+    @property
+    def data(self):
+        start = self.offset + HEADER_SIZE
+        return self._buf[start:start + self.data_length]
+
+    @property
+    def size(self):
+        return HEADER_SIZE + self.data_length
+
+    @property
+    def end(self):
+        return self.offset + self.size
+
+    @property
+    def raw(self):
+        return self._buf[self.offset:self.end]
+
+    def hash(self):
+        return self._hash(self.raw)
+
+
+class BlockReader:
+    # memory maps the chain file read only so a scan only faults in the pages
+    # it actually touches. walking the chain reads just the data length of
+    # each block to find the next one
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        self.size = os.fstat(self._file.fileno()).st_size
+        # blocks handed out, for --profile
+        self.touched = 0
+        if self.size:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._buf = memoryview(self._map)
+        else:
+            # mmap refuses zero length files
+            self._map = None
+            self._buf = memoryview(b"")
+        # the chain's block hash, named by its INITIAL block
+        self.hash_name = DEFAULT_HASH
+        if self.size >= HEADER_SIZE:
+            genesis = BlockView(self._buf, 0)
+            if genesis.end <= self.size:
+                try:
+                    self.hash_name = hash_name(bytes(genesis.data))
+                except ChainError:
+                    self.close()
+                    raise
+        self.block_hash = HASHES[self.hash_name]
+
+    def block_at(self, offset):
+        if offset + HEADER_SIZE > self.size:
+            raise ChainError(f"truncated block header at offset {offset}")
+        block = BlockView(self._buf, offset, self.block_hash)
+        if block.end > self.size:
+            raise ChainError(f"truncated block data at offset {offset}")
+        self.touched += 1
+        return block
+
+    def iter_from(self, offset):
+        while offset < self.size:
+            block = self.block_at(offset)
+            yield block
+            offset = block.end
+
+    def item_bytes(self, offset):
+        # the raw item id of the block at offset, to compare with item_key()
+        # without decoding it. sliced from the mmap rather than the
+        # memoryview, which compares at half the speed
+        start = offset + ITEM_ID_OFFSET
+        return self._map[start:start + 4]
+
+    def raw(self, start, end):
+        # the chain's bytes in [start, end) as a view into the mapping, for
+        # hashing blocks whose bounds are already known
+        return self._buf[start:end]
+
+    def iter_offsets(self, start=0, end=None):
+        # where each block from start begins, up to the first one at or past
+        # end or the end of the chain. only the data lengths are read, no
+        # view is made of any block
+        # the mmap is None for an empty chain, which has nothing to walk
+        buf = self._map
+        size = self.size
+        stop = size if end is None else min(end, size)
+        offset = start
+        while offset < stop:
+            if offset + HEADER_SIZE > size:
+                raise ChainError(f"truncated block header at offset {offset}")
+            next_offset = offset + HEADER_SIZE + _uint.unpack_from(buf, offset + DATA_LENGTH_OFFSET)[0]
+            if next_offset > size:
+                raise ChainError(f"truncated block data at offset {offset}")
+            yield offset
+            offset = next_offset
+
+    def iter_item(self, item_id, start=0, end=None):
+        # the blocks of one item from start up to the first block at or past
+        # end, or the end of the chain. the id is packed once and compared
+        # with each block's raw id, so a block of another item is stepped
+        # over without a view being made or a field of it decoded
+        key = item_key(item_id)
+        buf = self._map
+        for offset in self.iter_offsets(start, end):
+            if buf[offset + ITEM_ID_OFFSET:offset + ITEM_ID_OFFSET + 4] == key:
+                yield self.block_at(offset)
+
+    def __iter__(self):
+        return self.iter_from(0)
+
+    def close(self):
+        profiling.count("blocks_touched", self.touched)
+        self.touched = 0
+        self._buf.release()
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                # a caller still holds a field view, the mapping goes away with it
+                pass
+            self._map = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
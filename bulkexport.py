@@ -0,0 +1,166 @@
+import csv
+import json
+import os
+import shutil
+import tempfile
+from array import array
+
+from block import HASH_SIZE, STATE_SIZE
+
+
+# blocks out of the chain for analysis, one at a time so memory does not
+# grow with the chain. jsonl and csv rows have these fields:
+#   offset     where the block starts in the chain file
+#   hash       the whole block's hash, by the chain's block hash, hex
+#   prev_hash  the parent's hash, hex
+#   timestamp  unix time as stored
+#   case_id, item_id, state
+#   data       the data field as text, the owner for RELEASED
+FIELDS = ("offset", "hash", "prev_hash", "timestamp", "case_id", "item_id", "state", "data")
+
+# the columns format is every column in turn, each one value per block, in
+# a file with no header. <file>.json next to it gives the block count and
+# the columns' numpy types, so the whole file comes back in one call:
+#
+#   meta = json.load(open("chain.cols.json"))
+#   cols = np.fromfile("chain.cols", dtype=[(name, kind, meta["count"]) for name, kind in meta["columns"]])[0]
+#   pd.DataFrame({name: cols[name] for name in cols.dtype.names})
+#
+# case ids are 128 bits, more than numpy holds in one integer, so they are
+# split in two. the data field is left out, it has no fixed size
+COLUMNS = (
+    ("offset", "<u8"),
+    ("timestamp", "<f8"),
+    ("case_id_low", "<u8"),
+    ("case_id_high", "<u8"),
+    ("item_id", "<u4"),
+    ("state", f"S{STATE_SIZE}"),
+    ("hash", f"S{HASH_SIZE}"),
+    ("prev_hash", f"S{HASH_SIZE}"),
+    ("data_length", "<u4"),
+)
+COLUMNS_SUFFIX = ".json"
+# blocks held per column before they go to the column's scratch file
+CHUNK = 65536
+
+FORMATS = ("jsonl", "csv", "columns")
+_LOW = (1 << 64) - 1
+
+
+def format_for(path):
+    # the format a file name asks for, jsonl unless it says otherwise
+    name = path.lower()
+    if name.endswith(".csv"):
+        return "csv"
+    if name.endswith(".cols"):
+        return "columns"
+    return "jsonl"
+
+
+def block_fields(block):
+    # the FIELDS of one block, in order
+    return (block.offset, block.hash().hex(), bytes(block.prev_hash).hex(), block.timestamp,
+            block.case_id, block.item_id, block.state, bytes(block.data).rstrip(b"\0").decode(errors="replace"))
+
+
+def write_jsonl(blocks, stream):
+    count = 0
+    for block in blocks:
+        stream.write(json.dumps(dict(zip(FIELDS, block_fields(block)))) + "\n")
+        count += 1
+    return count
+
+
+def write_csv(blocks, stream):
+    writer = csv.writer(stream)
+    writer.writerow(FIELDS)
+    count = 0
+    for block in blocks:
+        writer.writerow(block_fields(block))
+        count += 1
+    return count
+
+
+class _ColumnWriter:
+    # buffers up to CHUNK values of every column and spills them to one
+    # scratch file per column, which are joined once the count is known
+    def __init__(self, directory):
+        self._scratch = tempfile.TemporaryDirectory(dir=directory, prefix=".export-")
+        self._files = [open(os.path.join(self._scratch.name, name), "wb") for name, _ in COLUMNS]
+        self.count = 0
+        self._clear()
+
+    def _clear(self):
+        self._offsets = array("Q")
+        self._timestamps = array("d")
+        self._case_low = array("Q")
+        self._case_high = array("Q")
+        self._items = array("I")
+        self._states = bytearray()
+        self._hashes = bytearray()
+        self._prev_hashes = bytearray()
+        self._lengths = array("I")
+        self._buffered = 0
+
+    def add(self, block):
+        case_id = block.case_id
+        self._offsets.append(block.offset)
+        self._timestamps.append(block.timestamp)
+        self._case_low.append(case_id & _LOW)
+        self._case_high.append(case_id >> 64)
+        self._items.append(block.item_id)
+        self._states += block.state_bytes
+        self._hashes += block.hash()
+        self._prev_hashes += block.prev_hash
+        self._lengths.append(block.data_length)
+        self.count += 1
+        self._buffered += 1
+        if self._buffered >= CHUNK:
+            self._spill()
+
+    def _spill(self):
+        buffers = (self._offsets, self._timestamps, self._case_low, self._case_high, self._items,
+                   self._states, self._hashes, self._prev_hashes, self._lengths)
+        for f, buffer in zip(self._files, buffers):
+            f.write(buffer)
+        self._clear()
+
+    def finish(self, path):
+        # writes the columns to path and the layout next to it
+        self._spill()
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as out:
+            for f in self._files:
+                f.close()
+                with open(f.name, "rb") as column:
+                    shutil.copyfileobj(column, out)
+        os.replace(tmp_path, path)
+        with open(path + COLUMNS_SUFFIX, "w") as f:
+            json.dump({"count": self.count, "columns": COLUMNS}, f)
+            f.write("\n")
+
+    def close(self):
+        for f in self._files:
+            f.close()
+        self._scratch.cleanup()
+
+
+def write_columns(blocks, path):
+    writer = _ColumnWriter(os.path.dirname(os.path.abspath(path)))
+    try:
+        for block in blocks:
+            writer.add(block)
+        writer.finish(path)
+    finally:
+        writer.close()
+    return writer.count
+
+
+def export_blocks(blocks, fmt, out):
+    # writes blocks in fmt and returns how many. out is a text stream for
+    # jsonl and csv and a file name for columns
+    if fmt == "columns":
+        return write_columns(blocks, out)
+    if fmt == "csv":
+        return write_csv(blocks, out)
+    return write_jsonl(blocks, out)
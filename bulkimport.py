@@ -0,0 +1,172 @@
+import csv
+import json
+import sys
+import time
+
+from block import CASE_ID_LIMIT, ITEM_ID_LIMIT, REMOVED_STATES, ChainError
+from writer import append_blocks
+
+
+# one action per row or line. csv files need a header naming the columns,
+# jsonl lines are objects with the same keys:
+#   action   add, checkout, checkin or remove
+#   case_id  only used by add
+#   item_id
+#   reason   remove only, one of DISPOSED, DESTROYED or RELEASED
+#   owner    remove only, required when the reason is RELEASED
+DEFAULT_BATCH_SIZE = 1000
+PROGRESS_EVERY = 100000
+
+# state an item must be in for each action, None means it must not exist
+ACTION_REQUIRES = {
+    "add": None,
+    "checkout": "CHECKEDIN",
+    "checkin": "CHECKEDOUT",
+    "remove": "CHECKEDIN",
+}
+ACTION_RESULTS = {
+    "add": "CHECKEDIN",
+    "checkout": "CHECKEDOUT",
+    "checkin": "CHECKEDIN",
+}
+
+
+class ActionError(ChainError):
+    pass
+
+
+def read_actions(stream, fmt):
+    # yields (line number, action dict) without reading ahead of the caller
+    if fmt == "csv":
+        rows = csv.DictReader(stream)
+        for row in rows:
+            yield rows.line_num, row
+    else:
+        for line_num, line in enumerate(stream, 1):
+            line = line.strip()
+            if line:
+                try:
+                    action = json.loads(line)
+                except ValueError as e:
+                    raise ActionError(f"line {line_num}: {e}")
+                if not isinstance(action, dict):
+                    raise ActionError(f"line {line_num}: not a JSON object")
+                yield line_num, action
+
+
+class Importer:
+    # checks each action against the item index plus whatever is waiting in
+    # the current batch, so memory only grows with the batch size. indexes
+    # is a store.Indexes
+    def __init__(self, path, indexes, batch_size=DEFAULT_BATCH_SIZE):
+        self.path = path
+        self.indexes = indexes
+        self.batch_size = batch_size
+        self.records = []
+        # the state each record's item was checked against, so a batch that
+        # another writer got in ahead of is refused rather than written
+        self.expected = []
+        self.pending = {}
+        self.count = 0
+        self.blocks = 0
+
+    def current(self, item_id):
+        # (case id, state) of an item or None if it does not exist
+        if item_id in self.pending:
+            return self.pending[item_id]
+        items = self.indexes.items
+        if items.filtered and item_id not in self.indexes.item_filter:
+            # the item filter is sure it was never added
+            return None
+        status = items.status(item_id)
+        if status is None:
+            return None
+        return status[0], status[1]
+
+    def apply(self, action):
+        name = str(action.get("action", "")).strip().lower()
+        if name not in ACTION_REQUIRES:
+            raise ActionError(f"unknown action {name!r}")
+        try:
+            item_id = int(action["item_id"])
+        except (KeyError, TypeError, ValueError):
+            raise ActionError("item_id is missing or not an integer")
+        if not 0 <= item_id < ITEM_ID_LIMIT:
+            raise ActionError(f"item_id {item_id} is out of range")
+
+        current = self.current(item_id)
+        required = ACTION_REQUIRES[name]
+        if required is None:
+            if current is not None:
+                raise ActionError(f"item {item_id} already exists")
+            try:
+                case_id = int(action["case_id"])
+            except (KeyError, TypeError, ValueError):
+                raise ActionError("case_id is missing or not an integer")
+            if not 0 <= case_id < CASE_ID_LIMIT:
+                raise ActionError(f"case_id {case_id} is out of range")
+        else:
+            if current is None:
+                raise ActionError(f"item {item_id} not found")
+            case_id, state = current
+            if state != required:
+                raise ActionError(f"cannot {name} item {item_id}, it is {state}")
+
+        data = b""
+        if name == "remove":
+            new_state = str(action.get("reason") or "").upper()
+            owner = action.get("owner") or ""
+            if new_state not in REMOVED_STATES:
+                raise ActionError(f"reason must be one of {', '.join(REMOVED_STATES)}")
+            if new_state == "RELEASED" and not owner:
+                raise ActionError("owner is required when the item is RELEASED")
+            if owner:
+                data = owner.encode() + b"\0"
+        else:
+            new_state = ACTION_RESULTS[name]
+
+        self.records.append((case_id, item_id, new_state, data))
+        self.expected.append(None if current is None else current[1])
+        self.pending[item_id] = (case_id, new_state)
+        self.count += 1
+        if len(self.records) >= self.batch_size:
+            self.flush()
+
+    def undo(self, start):
+        # drops every action applied since there were start records, for a
+        # caller that takes a group of actions whole or not at all
+        del self.records[start:]
+        del self.expected[start:]
+        self.count = self.blocks + len(self.records)
+        self.pending = {item_id: (case_id, state) for case_id, item_id, state, _ in self.records}
+
+    def flush(self):
+        # writes the batch, returns the timestamps of its blocks
+        if not self.records:
+            return []
+        timestamps = append_blocks(self.path, self.indexes, self.records, self.expected)
+        self.blocks += len(self.records)
+        self.records = []
+        self.expected = []
+        self.pending = {}
+        return timestamps
+
+
+def import_actions(path, indexes, stream, fmt, batch_size=DEFAULT_BATCH_SIZE, progress=sys.stderr):
+    # streams actions into the chain. everything before a bad action is
+    # committed and the bad one raises with its line number. returns the
+    # number of blocks written and the seconds it took
+    importer = Importer(path, indexes, batch_size)
+    start = time.perf_counter()
+    try:
+        for line_num, action in read_actions(stream, fmt):
+            try:
+                importer.apply(action)
+            except ActionError as e:
+                raise ActionError(f"line {line_num}: {e}")
+            if progress is not None and importer.count % PROGRESS_EVERY == 0:
+                elapsed = time.perf_counter() - start
+                print(f"{importer.count} actions, {importer.count / elapsed:.0f} actions/s", file=progress)
+    finally:
+        importer.flush()
+    return importer.blocks, time.perf_counter() - start
@@ -0,0 +1,88 @@
+import os
+import sys
+
+
+# a daemon started with `bchoc serve` listens on <chain>.sock. requests and
+# replies are one json object per line:
+#   -> {"argv": ["bchoc", "checkout", "-i", "2"]}
+#   <- {"status": 0, "stdout": "...", "stderr": "..."}
+SOCKET_SUFFIX = ".sock"
+
+# serve starts the daemon. import, verify-proof and export stream our
+# stdin or stdout or name files relative to us. they all stay local
+LOCAL_COMMANDS = ("serve", "import", "verify-proof", "export")
+
+# global options before the command that take a value
+VALUE_OPTIONS = ("--durability", "--profile-dump")
+
+
+def socket_path(chain_path):
+    return os.path.abspath(chain_path) + SOCKET_SUFFIX
+
+
+class Client:
+    # one connection that can run any number of commands, for scripts that
+    # want to skip starting a python process per command
+    def __init__(self, chain_path):
+        # socket, json and what they drag in are only worth importing once
+        # there is a daemon to talk to
+        import socket
+
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self._sock.connect(socket_path(chain_path))
+        except OSError:
+            self._sock.close()
+            raise
+        self._file = self._sock.makefile("rwb")
+
+    def run(self, argv):
+        # (status, stdout, stderr) of running argv on the daemon
+        import json
+
+        self._file.write(json.dumps({"argv": list(argv)}).encode() + b"\n")
+        self._file.flush()
+        line = self._file.readline()
+        if not line:
+            raise ConnectionError("daemon closed the connection")
+        reply = json.loads(line)
+        return reply["status"], reply["stdout"], reply["stderr"]
+
+    def close(self):
+        self._file.close()
+        self._sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def forward(chain_path, argv):
+    # runs argv on a daemon serving chain_path and passes its output through.
+    # returns the exit status, or None when the command has to run here
+    args = iter(argv[1:])
+    for arg in args:
+        if arg.startswith("--profile"):
+            # profiling measures this process, not the daemon
+            return None
+        if arg in VALUE_OPTIONS:
+            next(args, None)
+        elif not arg.startswith("-"):
+            if arg in LOCAL_COMMANDS:
+                return None
+            break
+    else:
+        return None
+    if not os.path.exists(socket_path(chain_path)):
+        return None
+    try:
+        with Client(chain_path) as client:
+            status, stdout, stderr = client.run(argv)
+    except OSError:
+        # a socket left behind by a daemon that is gone
+        return None
+    sys.stdout.write(stdout)
+    sys.stderr.write(stderr)
+    return status
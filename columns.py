@@ -0,0 +1,100 @@
+from array import array
+from bisect import bisect_left
+
+from block import CASE_ID_SIZE
+from index import CODE_STATES, STATE_CODES
+
+
+# the header fields of a whole chain held in flat arrays, one column per
+# field, instead of an object per block. per block that is
+#   timestamp   8 bytes   array('d')
+#   case id    16 bytes   bytearray, 16 bytes per block
+#   item id     4 bytes   array('I')
+#   state       1 byte    bytearray of index.STATE_CODES, 0 if unknown
+#   offset      8 bytes   array('Q')
+# or 37 bytes, plus whatever the arrays over allocate while growing (at
+# most about an eighth). bench/memory.py holds this to MAX_BYTES_PER_BLOCK.
+# a python object per block with a __dict__ would be a few hundred bytes
+BYTES_PER_BLOCK = 8 + CASE_ID_SIZE + 4 + 1 + 8
+MAX_BYTES_PER_BLOCK = 48
+
+
+class BlockRow:
+    # a view of one row, built only when asked for. it has the same field
+    # names as block.BlockView so the two can be used interchangeably
+    __slots__ = ("_columns", "index")
+
+    def __init__(self, columns, index):
+        self._columns = columns
+        self.index = index
+
+    @property
+    def offset(self):
+        return self._columns.offsets[self.index]
+
+    @property
+    def timestamp(self):
+        return self._columns.timestamps[self.index]
+
+    @property
+    def case_id(self):
+        start = self.index * CASE_ID_SIZE
+        return int.from_bytes(self._columns.case_ids[start:start + CASE_ID_SIZE], "little")
+
+    @property
+    def item_id(self):
+        return self._columns.item_ids[self.index]
+
+    @property
+    def state(self):
+        return CODE_STATES.get(self._columns.states[self.index], "")
+
+
+class ChainColumns:
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.timestamps = array("d")
+        self.case_ids = bytearray()
+        self.item_ids = array("I")
+        self.states = bytearray()
+        self.offsets = array("Q")
+        # bytes of the chain loaded so far
+        self.end = 0
+
+    def extend(self, reader):
+        # append every block after the last one loaded, so a chain that grew
+        # only costs the new blocks
+        if reader.size < self.end:
+            self.clear()
+        for block in reader.iter_from(self.end):
+            self.timestamps.append(block.timestamp)
+            self.case_ids += block.case_id_bytes
+            self.item_ids.append(block.item_id)
+            self.states.append(STATE_CODES.get(block.state, 0))
+            self.offsets.append(block.offset)
+            self.end = block.end
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield BlockRow(self, index)
+
+    def __reversed__(self):
+        for index in range(len(self) - 1, -1, -1):
+            yield BlockRow(self, index)
+
+    def row_at(self, offset):
+        # the row of the block starting at offset
+        index = bisect_left(self.offsets, offset)
+        if index == len(self) or self.offsets[index] != offset:
+            raise KeyError(offset)
+        return BlockRow(self, index)
+
+    def nbytes(self):
+        # memory actually reserved by the columns, over allocation included
+        return sum(column.__sizeof__() for column in
+                   (self.timestamps, self.case_ids, self.item_ids, self.states, self.offsets))
@@ -0,0 +1,25 @@
+import sys
+
+from block import ChainError
+from commands.common import close_store, format_time, open_store
+
+
+def run(args):
+    # ex: bchoc add -c case_id -i item_id [-i item_id ...]
+
+    # -i can have multiple uses so its output is a list i believe
+    store = open_store(create=True)
+    try:
+        # the whole batch goes to disk in a single write and fsync
+        timestamps = store.add(args.case_id, args.item_id)
+    except ChainError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    finally:
+        close_store(store)
+
+    print(f"Case: {args.case_id}")
+    for item_id, timestamp in zip(args.item_id, timestamps):
+        print(f"Added item: {item_id}")
+        print("  Status: CHECKEDIN")
+        print(f"  Time of action: {format_time(timestamp)}")
@@ -0,0 +1,19 @@
+import sys
+
+from block import ChainError
+from commands.common import close_store, format_time, open_store
+
+
+def run(args):
+    store = open_store()
+    try:
+        case_id, timestamp = store.checkin(args.item_id)
+    except ChainError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    finally:
+        close_store(store)
+    print(f"Case: {case_id}")
+    print(f"Checked in item: {args.item_id}")
+    print("  Status: CHECKEDIN")
+    print(f"  Time of action: {format_time(timestamp)}")
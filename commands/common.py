@@ -0,0 +1,37 @@
+import sys
+from datetime import datetime, timezone
+
+from bchoc import filepath_to_chain
+from block import ChainError
+from store import ChainStore
+
+
+# set by the daemon so the store and its indexes stay open from one
+# command to the next
+cached_store = None
+
+
+def format_time(timestamp):
+    return datetime.fromtimestamp(timestamp, timezone.utc).strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+
+
+def print_entry(case_id, item_id, state, timestamp):
+    # one block as log shows it, from the fields store.iter_log(decoded=True) gives
+    sys.stdout.write(f"Case: {case_id}\nItem: {item_id}\nAction: {state}\nTime: {format_time(timestamp)}\n\n")
+
+
+def open_store(create=False, rebuild=False):
+    if cached_store is not None:
+        if rebuild:
+            cached_store.reindex()
+        return cached_store
+    try:
+        return ChainStore.open(filepath_to_chain, create, rebuild)
+    except ChainError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+
+def close_store(store):
+    if store is not cached_store:
+        store.close()
@@ -0,0 +1,37 @@
+import sys
+
+import profiling
+from block import ChainError
+from commands.common import close_store, open_store
+
+
+def run(args):
+    # ex: bchoc export -o chain.csv
+    # ex: bchoc export -c 66 -f jsonl | jq .hash
+    from bulkexport import format_for
+
+    fmt = args.format or format_for(args.output)
+    if fmt == "columns" and args.output == "-":
+        print("Error: the columns format needs a file, give one with -o")
+        sys.exit(1)
+    store = open_store()
+    try:
+        if fmt == "columns":
+            stream = args.output
+        else:
+            stream = sys.stdout if args.output == "-" else open(args.output, "w", newline="")
+    except OSError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    try:
+        with profiling.phase("scan"):
+            count = store.export(stream, fmt, args.case_id, args.item_id)
+    except (ChainError, OSError) as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+    finally:
+        close_store(store)
+        if stream is not sys.stdout and fmt != "columns":
+            stream.close()
+    if args.output != "-":
+        print(f"Exported {count} blocks to {args.output}")
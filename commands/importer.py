@@ -0,0 +1,27 @@
+import sys
+
+from block import ChainError
+from commands.common import close_store, open_store
+
+
+def run(args):
+    # ex: bchoc import actions.csv
+    # ex: intake | bchoc import -f jsonl -b 5000
+    fmt = args.format or ("csv" if args.file.lower().endswith(".csv") else "jsonl")
+    store = open_store(create=True)
+    try:
+        stream = sys.stdin if args.file == "-" else open(args.file, newline="")
+    except OSError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    try:
+        blocks, elapsed = store.import_actions(stream, fmt, args.batch_size, sys.stderr)
+    except ChainError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    finally:
+        close_store(store)
+        if stream is not sys.stdin:
+            stream.close()
+    rate = blocks / elapsed if elapsed else 0
+    print(f"Imported {blocks} actions in {elapsed:.2f}s ({rate:.0f} actions/s)")
@@ -0,0 +1,32 @@
+import os
+import sys
+
+from bchoc import filepath_to_chain
+from block import DEFAULT_HASH, BlockReader, ChainError
+from writer import create_chain
+
+
+def run(args):
+    if os.path.exists(filepath_to_chain):
+        try:
+            reader = BlockReader(filepath_to_chain)
+        except ChainError as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+        with reader:
+            try:
+                first = next(iter(reader), None)
+                valid = first is not None and first.state == "INITIAL"
+            except ChainError:
+                valid = False
+            first = None
+        if not valid:
+            print("Error: blockchain file does not start with an INITIAL block")
+            sys.exit(1)
+        if args.hash and args.hash != reader.hash_name:
+            print(f"Error: blockchain file is already linked with {reader.hash_name}")
+            sys.exit(1)
+        print("Blockchain file found with INITIAL block.")
+    else:
+        create_chain(filepath_to_chain, args.hash or DEFAULT_HASH)
+        print("Blockchain file not found. Created INITIAL block.")
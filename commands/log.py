@@ -0,0 +1,21 @@
+import sys
+
+import profiling
+from block import ChainError
+from commands.common import close_store, open_store, print_entry
+
+
+def run(args):
+    # ex: bchoc log [-r] [-n 5] [-c 66] [-i 2]
+    store = open_store()
+    entries = store.iter_log(args.case_id, args.item_id, args.reverse, args.num_entries, decoded=True)
+    try:
+        with profiling.phase("scan"):
+            for entry in entries:
+                print_entry(*entry)
+    except ChainError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    finally:
+        entries.close()
+        close_store(store)
@@ -0,0 +1,27 @@
+import json
+import sys
+
+from block import ChainError
+from commands.common import close_store, open_store
+
+
+def run(args):
+    # ex: bchoc prove -i 2 --block 3 > proof.json
+    store = open_store()
+    try:
+        raw, number, size, path, root = store.prove(args.item_id, args.block)
+        algorithm = store.hash_name()
+    except ChainError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    finally:
+        close_store(store)
+    # the block's own bytes go along so the proof says what was proven
+    print(json.dumps({
+        "block": raw.hex(),
+        "hash": algorithm,
+        "block_number": number,
+        "tree_size": size,
+        "path": [digest.hex() for digest in path],
+        "root": root.hex(),
+    }, indent=2))
@@ -0,0 +1,16 @@
+import sys
+
+from block import ChainError
+from commands.common import close_store, open_store
+
+
+def run(args):
+    try:
+        store = open_store(rebuild=True)
+    except ChainError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    items, cases, manifest, _, _, offsets = store.indexes
+    print(f"Indexed {offsets.count} blocks, {items.count} items in {cases.count} cases, "
+          f"{len(manifest.segments)} sealed segments")
+    close_store(store)
@@ -0,0 +1,22 @@
+import sys
+
+from block import ChainError
+from commands.common import close_store, format_time, open_store
+
+
+def run(args):
+    store = open_store()
+    try:
+        # ex: bchoc remove -i 6 -y idk [-o Chris]
+        case_id, timestamp = store.remove(args.item_id, args.why, args.owner)
+    except ChainError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    finally:
+        close_store(store)
+    print(f"Case: {case_id}")
+    print(f"Removed item: {args.item_id}")
+    print(f"  Status: {args.why.upper()}")
+    if args.owner:
+        print(f"  Owner info: {args.owner}")
+    print(f"  Time of action: {format_time(timestamp)}")
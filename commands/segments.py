@@ -0,0 +1,28 @@
+import sys
+
+from block import ChainError
+from commands.common import close_store, format_time, open_store
+
+
+def run(args):
+    # ex: bchoc segments
+    store = open_store()
+    try:
+        segments = store.segments()
+        manifest = store.indexes.manifest
+    except ChainError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    finally:
+        close_store(store)
+
+    for segment in segments:
+        print(f"Segment: {segment.number}")
+        print(f"  Blocks: {segment.first_block}-{segment.first_block + segment.blocks - 1}")
+        print(f"  Bytes: {segment.start}-{segment.end}")
+        print(f"  Time: {format_time(segment.min_time)} to {format_time(segment.max_time)}")
+        print(f"  Cases: {segment.min_case} to {segment.max_case}")
+        print(f"  Items: {segment.min_item} to {segment.max_item}")
+        print(f"  First hash: {segment.first_hash.hex()}")
+        print(f"  Last hash: {segment.last_hash.hex()}")
+    print(f"Open segment: {manifest.open_blocks} blocks from byte {manifest.open_start}")
@@ -0,0 +1,15 @@
+import sys
+
+from bchoc import filepath_to_chain
+from block import ChainError
+from daemon import serve
+
+
+def run(args):
+    # ex: bchoc serve &
+    # other bchoc calls on the same chain are sent to it from then on
+    try:
+        serve(filepath_to_chain)
+    except ChainError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
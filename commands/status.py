@@ -0,0 +1,24 @@
+import sys
+
+from block import ChainError
+from commands.common import close_store, open_store
+
+
+def run(args):
+    # ex: bchoc status -c 66 or bchoc status -i 1
+    store = open_store()
+    try:
+        rows = store.status(args.case_id, args.item_id)
+    except ChainError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    finally:
+        close_store(store)
+
+    for item_id, case_id, state, owner, offset in rows:
+        print(f"Item: {item_id}")
+        print(f"  Case: {case_id}")
+        print(f"  Status: {state}")
+        if owner is not None:
+            print(f"  Owner info: {owner}")
+        print(f"  Last block at byte: {offset}")
@@ -0,0 +1,26 @@
+import sys
+
+from block import ChainError
+from commands.common import close_store, open_store
+
+
+def run(args):
+    store = open_store()
+    try:
+        verifier = store.verify(args.incremental, args.jobs)
+    except ChainError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+    finally:
+        close_store(store)
+    if args.incremental and not verifier.start:
+        print("No usable checkpoint, verified the whole chain", file=sys.stderr)
+    print(f"Transactions in blockchain: {verifier.count}")
+    if not verifier.errors:
+        print("State of blockchain: CLEAN")
+    else:
+        print("State of blockchain: ERROR")
+        for digest, message in verifier.errors:
+            print(f"Bad block: {digest.hex()}")
+            print(message)
+        sys.exit(1)
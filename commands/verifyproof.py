@@ -0,0 +1,75 @@
+import json
+import os
+import sys
+
+from bchoc import filepath_to_chain
+from block import DEFAULT_HASH, HASHES, HEADER_SIZE, BlockView, ChainError
+from commands.common import close_store, format_time, open_store
+from merkle import root_from_path
+
+
+def load_proof(file):
+    # (raw block, block hash function, block number, tree size, sibling
+    # hashes, root) from a proof written by prove. proofs from before the
+    # hash was recorded are sha256
+    if file == "-":
+        proof = json.load(sys.stdin)
+    else:
+        with open(file) as f:
+            proof = json.load(f)
+    algorithm = proof.get("hash", DEFAULT_HASH)
+    if algorithm not in HASHES:
+        raise ValueError(f"unknown block hash {algorithm}")
+    return (bytes.fromhex(proof["block"]), HASHES[algorithm], int(proof["block_number"]), int(proof["tree_size"]),
+            [bytes.fromhex(digest) for digest in proof["path"]], bytes.fromhex(proof["root"]))
+
+
+def run(args):
+    # ex: bchoc verify-proof proof.json [--root HEX]
+    try:
+        raw, block_hash, number, size, path, root = load_proof(args.file)
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print(f"Error: cannot read proof: {e}")
+        sys.exit(1)
+    block = BlockView(memoryview(raw), 0)
+    if len(raw) < HEADER_SIZE or block.end != len(raw):
+        print("Error: the proof's block is malformed")
+        sys.exit(1)
+
+    # the root has to come from somewhere the auditor trusts, a published
+    # one or the chain at hand. the one in the proof only says what it claims
+    if args.root:
+        try:
+            trusted = bytes.fromhex(args.root)
+        except ValueError:
+            print("Error: --root is not hex")
+            sys.exit(1)
+        source = "the given root"
+    elif os.path.exists(filepath_to_chain):
+        store = open_store()
+        try:
+            trusted = store.merkle_root(size)
+        except ChainError as e:
+            print(f"Error: {e}")
+            sys.exit(1)
+        finally:
+            close_store(store)
+        source = f"the root of the first {size} blocks of the chain"
+    else:
+        print("Error: no blockchain to check the root against, give one with --root")
+        sys.exit(1)
+
+    digest = block_hash(raw)
+    print(f"Block: {digest.hex()}")
+    print(f"Case: {block.case_id}")
+    print(f"Item: {block.item_id}")
+    print(f"Action: {block.state}")
+    print(f"Time: {format_time(block.timestamp)}")
+    print(f"Block number: {number} of {size}")
+    if root_from_path(digest, number, size, path) != root:
+        print("Proof: INVALID, the path does not lead to the proof's root")
+        sys.exit(1)
+    if root != trusted:
+        print(f"Proof: INVALID, the root does not match {source}")
+        sys.exit(1)
+    print(f"Proof: VALID, it matches {source}")
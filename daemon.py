@@ -0,0 +1,121 @@
+import io
+import json
+import os
+import selectors
+import signal
+import socket
+import sys
+import time
+from contextlib import redirect_stderr, redirect_stdout
+
+import argtest
+import durability
+from block import ChainError
+from client import Client, socket_path
+from commands import common
+from store import ChainStore
+from writer import sync_chain
+
+
+def handle(argv):
+    # runs one command exactly as the cli would and captures what it prints
+    stdout = io.StringIO()
+    stderr = io.StringIO()
+    status = 0
+    with redirect_stdout(stdout), redirect_stderr(stderr):
+        try:
+            argtest.run(argtest.parser.parse_args(argv))
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                status = e.code or 0
+            else:
+                print(e.code, file=sys.stderr)
+                status = 1
+        except Exception as e:
+            # one bad command must not take the daemon down with it
+            print(f"Error: {e}")
+            status = 1
+    return {"status": status, "stdout": stdout.getvalue(), "stderr": stderr.getvalue()}
+
+
+def serve(chain_path):
+    # keeps a store with its indexes and every block header open and
+    # answers commands on <chain>.sock until interrupted. connections are
+    # multiplexed but commands run one at a time, in the order their lines
+    # arrive
+    path = socket_path(chain_path)
+    if os.path.exists(path):
+        try:
+            Client(chain_path).close()
+        except OSError:
+            os.unlink(path)
+        else:
+            raise ChainError(f"a daemon is already serving {chain_path}")
+    store = ChainStore.open(chain_path)
+    # open the indexes now rather than on the first command
+    store.indexes
+    store.keep_columns()
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen()
+    server.setblocking(False)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    common.cached_store = store
+    selector = selectors.DefaultSelector()
+    selector.register(server, selectors.EVENT_READ)
+    pending = {}
+    # under batched durability the daemon wakes up to fsync what appends
+    # left unsynced once the time limit passes, whoever wrote them
+    batch = durability.current
+    timeout = batch.ms / 1000 if batch.mode == durability.FSYNC_BATCH else None
+    next_sync = time.monotonic()
+    print(f"Serving {chain_path} on {path}", flush=True)
+    try:
+        while True:
+            events = selector.select(timeout)
+            if timeout is not None and time.monotonic() >= next_sync:
+                sync_chain(chain_path, store.indexes)
+                next_sync = time.monotonic() + timeout
+            for key, _ in events:
+                if key.fileobj is server:
+                    conn, _ = server.accept()
+                    conn.setblocking(False)
+                    selector.register(conn, selectors.EVENT_READ)
+                    pending[conn] = b""
+                    continue
+
+                conn = key.fileobj
+                try:
+                    data = conn.recv(65536)
+                except ConnectionError:
+                    data = b""
+                if not data:
+                    selector.unregister(conn)
+                    del pending[conn]
+                    conn.close()
+                    continue
+
+                pending[conn] += data
+                while b"\n" in pending[conn]:
+                    line, pending[conn] = pending[conn].split(b"\n", 1)
+                    try:
+                        reply = handle(json.loads(line)["argv"])
+                    except (ValueError, KeyError, TypeError):
+                        reply = {"status": 1, "stdout": "", "stderr": "Error: malformed request\n"}
+                    # replies can be large (a full log) so send them blocking
+                    conn.setblocking(True)
+                    try:
+                        conn.sendall(json.dumps(reply).encode() + b"\n")
+                    except ConnectionError:
+                        pass
+                    conn.setblocking(False)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        selector.close()
+        server.close()
+        os.unlink(path)
+        common.cached_store = None
+        store.close()
@@ -0,0 +1,77 @@
+# how hard an append pushes its blocks to stable storage, picked with
+# --durability or BCHOH_DURABILITY:
+#
+#   fsync-each             fsync the chain and every sidecar on each append.
+#                          the default, nothing acknowledged is ever lost
+#   fsync-batch[:N[:T]]    fsync once N blocks (default 1000) have built up
+#                          unsynced, or the oldest of them is T ms (default
+#                          100) old. a power cut loses at most that much
+#   os-buffered            never fsync, leave it to the os to write back.
+#                          for scratch and staging chains only
+#
+# the T ms limit is checked by the next append, or by the daemon's loop when
+# one is serving the chain, a lone cli call cannot wake up later to keep it.
+# anything that only reached the os survives the process dying, but a
+# crash of the machine can lose it and leave the sidecars out of step with
+# the chain. run `bchoc reindex` after one.
+#
+# bench/durability.py, 2000 single block appends on a one cpu linux vm
+# with a virtio disk, every sidecar including the merkle tree, the median
+# of five runs:
+#   fsync-each          1.59 ms per append    630 appends/s
+#   fsync-batch         0.56 ms per append   1783 appends/s
+#   os-buffered         0.53 ms per append   1903 appends/s
+# batch and buffered are within noise of each other, what is left is
+# building the blocks and updating the sidecars. a disk with a slower fsync
+# widens the gap to fsync-each
+FSYNC_EACH = "fsync-each"
+FSYNC_BATCH = "fsync-batch"
+OS_BUFFERED = "os-buffered"
+MODES = (FSYNC_EACH, FSYNC_BATCH, OS_BUFFERED)
+
+DEFAULT_BATCH_BLOCKS = 1000
+DEFAULT_BATCH_MS = 100
+
+
+class Durability:
+    __slots__ = ("mode", "blocks", "ms")
+
+    def __init__(self, mode=FSYNC_EACH, blocks=DEFAULT_BATCH_BLOCKS, ms=DEFAULT_BATCH_MS):
+        self.mode = mode
+        self.blocks = blocks
+        self.ms = ms
+
+    @classmethod
+    def parse(cls, text):
+        # fsync-each, os-buffered or fsync-batch with optional :N and :T.
+        # raises ValueError for anything else
+        mode, *limits = text.strip().lower().split(":")
+        if mode not in MODES or (limits and mode != FSYNC_BATCH) or len(limits) > 2:
+            raise ValueError(f"durability must be {FSYNC_EACH}, {OS_BUFFERED} or {FSYNC_BATCH}[:blocks[:ms]], not {text!r}")
+        durability = cls(mode)
+        if limits:
+            durability.blocks = int(limits[0])
+        if len(limits) > 1:
+            durability.ms = int(limits[1])
+        if durability.blocks < 1 or durability.ms < 0:
+            raise ValueError(f"batch limits must be at least 1 block and 0 ms, not {text!r}")
+        return durability
+
+    def due(self, unsynced_blocks, unsynced_since_ns, now_ns):
+        # whether an append that leaves unsynced_blocks unsynced, the oldest
+        # written at unsynced_since_ns, has to fsync
+        if self.mode == FSYNC_EACH:
+            return True
+        if self.mode == OS_BUFFERED:
+            return False
+        return (unsynced_blocks >= self.blocks
+                or now_ns - unsynced_since_ns >= self.ms * 1000000)
+
+    def __str__(self):
+        if self.mode != FSYNC_BATCH:
+            return self.mode
+        return f"{self.mode}:{self.blocks}:{self.ms}"
+
+
+# what appends in this process use, set from the command line
+current = Durability()
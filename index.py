@@ -0,0 +1,1003 @@
+import mmap
+import os
+import struct
+
+from block import CASE_ID_SIZE, DATA_LENGTH_OFFSET, HASH_SIZE, HEADER_SIZE, STATES, BlockReader, ChainError
+from locking import ChainLock
+
+
+# sidecar indexes kept next to the chain file
+#
+# the item and case indexes are open addressing hash tables that are memory
+# mapped, so a lookup only touches the header and one or two slots. the header records
+# how many bytes of the chain the table reflects. slots are written first
+# and that size last, so if we die part way through an update the next
+# open sees a short size and replays the tail of the chain over the table.
+#
+# several processes can have the same sidecars open. anything that writes
+# to them does so under the chain's exclusive lock (see locking.py), after
+# taking in what the others committed. a file is never truncated in place
+# while it may be mapped, a new one is renamed over it and whoever still
+# has the old one mapped keeps a consistent snapshot
+ITEM_INDEX_SUFFIX = ".items"
+ITEM_OWNERS_SUFFIX = ".owners"
+CASE_INDEX_SUFFIX = ".cases"
+CASE_POSTINGS_SUFFIX = ".caseblocks"
+BLOCK_OFFSETS_SUFFIX = ".offsets"
+SEGMENT_MANIFEST_SUFFIX = ".manifest"
+ITEM_FILTER_SUFFIX = ".itemfilter"
+
+INDEX_VERSION = 1
+# magic, version, capacity, used slots, chain bytes covered, table specific
+INDEX_HEADER = struct.Struct("<4s I I I Q Q")
+
+INITIAL_CAPACITY = 1024
+MAX_LOAD = 0.7
+
+# a segment is sealed at whichever of these it reaches first, about 10 MB
+# of plain adds and checkouts per segment. see SegmentManifest
+SEGMENT_BLOCKS = 131072
+SEGMENT_BYTES = 64 << 20
+
+# the item filter starts with 2048 slots, room for about 100k items. with
+# 10 bits per item and 7 of them set for each (fixed in ItemFilter._place)
+# an item that was never added comes back "maybe" about 1 time in 100. see
+# bench/itemfilter.py
+FILTER_INITIAL_SLOTS = 2048
+FILTER_ITEMS_PER_SLOT = 51
+# the filter is kept up to date at every size but only checked once the
+# item index is this big, about 12 million items. below that the index
+# stays in the page cache and a miss in it costs no more than a filter
+# check, past it a miss may go to disk
+FILTER_MIN_INDEX_BYTES = 1 << 30
+
+# state codes stored in an item slot, 0 marks an empty slot
+STATE_CODES = {state: code for code, state in enumerate(STATES, 1)}
+CODE_STATES = {code: state for state, code in STATE_CODES.items()}
+
+
+def _slot_hash(key, mask):
+    key ^= key >> 64
+    return (key * 2654435761) & mask
+
+
+class _MappedTable:
+    # subclasses set these and say how their keys and values sit in a slot.
+    # the second field of every slot is nonzero when the slot is in use
+    SUFFIX = None
+    MAGIC = None
+    SLOT = None
+
+    def __init__(self, chain_path):
+        self.chain_path = chain_path
+        self.path = chain_path + self.SUFFIX
+        self.extra = 0
+        self._file = None
+        self._map = None
+
+    @classmethod
+    def open(cls, chain_path):
+        table = cls(chain_path)
+        with ChainLock(chain_path):
+            if os.path.exists(table.path):
+                try:
+                    table._map_file()
+                    table._validate()
+                except ChainError:
+                    table.reset()
+            else:
+                table.reset()
+            table.refresh()
+        return table
+
+    def _create(self, capacity, path=None):
+        # path None replaces the table itself
+        tmp_path = path or self.path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(INDEX_HEADER.pack(self.MAGIC, INDEX_VERSION, capacity, 0, 0, 0))
+            f.truncate(INDEX_HEADER.size + capacity * self.SLOT.size)
+        if path is None:
+            os.replace(tmp_path, self.path)
+            self._map_file()
+
+    def _map_file(self):
+        self._file = open(self.path, "r+b")
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        magic, version, self.capacity, self.count, self.chain_size, self.extra = INDEX_HEADER.unpack_from(self._map, 0)
+        self._committed_extra = self.extra
+        expected = INDEX_HEADER.size + self.capacity * self.SLOT.size
+        if magic != self.MAGIC or version != INDEX_VERSION or len(self._map) != expected:
+            self.close()
+            raise ChainError(f"index {self.path} is corrupt")
+
+    def _validate(self):
+        pass
+
+    def _sync(self):
+        # take in what other processes committed since the table was mapped.
+        # one that grew or was reset renamed a new file over ours
+        try:
+            replaced = self._file is None or os.stat(self.path).st_ino != os.fstat(self._file.fileno()).st_ino
+        except FileNotFoundError:
+            self.reset()
+            return
+        if replaced:
+            self._unmap()
+            try:
+                self._map_file()
+            except ChainError:
+                self.reset()
+            return
+        _, _, _, self.count, self.chain_size, self.extra = INDEX_HEADER.unpack_from(self._map, 0)
+        self._committed_extra = self.extra
+
+    def _unmap(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _find(self, key):
+        # returns the slot position holding key and its fields, or the empty
+        # slot it would go in and None
+        packed = self._encode_key(key)
+        mask = self.capacity - 1
+        slot = _slot_hash(key, mask)
+        while True:
+            pos = INDEX_HEADER.size + slot * self.SLOT.size
+            fields = self.SLOT.unpack_from(self._map, pos)
+            if fields[1] == 0:
+                return pos, None
+            if fields[0] == packed:
+                return pos, fields
+            slot = (slot + 1) & mask
+
+    def _store(self, key, *values):
+        pos, fields = self._find(key)
+        if fields is None:
+            if self.count + 1 > self.capacity * MAX_LOAD:
+                self._grow()
+                pos, fields = self._find(key)
+            self.count += 1
+        self.SLOT.pack_into(self._map, pos, self._encode_key(key), *values)
+
+    def _slots(self):
+        for slot in range(self.capacity):
+            fields = self.SLOT.unpack_from(self._map, INDEX_HEADER.size + slot * self.SLOT.size)
+            if fields[1]:
+                yield fields
+
+    def _grow(self):
+        # rehash into a table twice the size and swap it in with a rename.
+        # the new table keeps the last committed header values so a crash
+        # before the current update commits still gets replayed
+        entries = list(self._slots())
+        chain_size, extra, committed_extra = self.chain_size, self.extra, self._committed_extra
+        tmp_path = self.path + ".tmp"
+        self._create(self.capacity * 2, tmp_path)
+        self._unmap()
+        os.replace(tmp_path, self.path)
+        self._map_file()
+        for fields in entries:
+            key = self._decode_key(fields[0])
+            self.SLOT.pack_into(self._map, self._find(key)[0], *fields)
+        self.count = len(entries)
+        self.chain_size, self.extra, self._committed_extra = chain_size, extra, committed_extra
+        self._write_header()
+
+    def _recount(self):
+        # the header's slot count may be behind if an update was cut short
+        self.count = sum(1 for _ in self._slots())
+
+    def _write_header(self):
+        INDEX_HEADER.pack_into(self._map, 0, self.MAGIC, INDEX_VERSION, self.capacity, self.count,
+                               self.chain_size, self._committed_extra)
+
+    def commit(self, chain_size, sync=True):
+        # slots first, then the header that says they are complete. without
+        # sync both are left to the os to write back
+        if sync:
+            self._map.flush()
+        self.chain_size = chain_size
+        self._committed_extra = self.extra
+        self._write_header()
+        if sync:
+            self._map.flush()
+
+    def refresh(self):
+        # replay any blocks appended since the table was last committed
+        with ChainLock(self.chain_path):
+            if not os.path.exists(self.chain_path):
+                if self.chain_size:
+                    self.reset()
+                return
+            self._sync()
+            if os.stat(self.chain_path).st_size == self.chain_size:
+                # nothing new, which is what every append finds
+                return
+            with BlockReader(self.chain_path) as reader:
+                if reader.size < self.chain_size:
+                    # the chain shrank under us, nothing in the table can be trusted
+                    self.reset()
+                if reader.size == self.chain_size:
+                    return
+                self._recount()
+                for block in reader.iter_from(self.chain_size):
+                    state = block.state
+                    if state != "INITIAL":
+                        self.record(block.offset, block.case_id, block.item_id, state)
+                self.commit(reader.size)
+
+    def reset(self):
+        self.close()
+        self._create(INITIAL_CAPACITY)
+
+    def rebuild(self):
+        with ChainLock(self.chain_path):
+            self.reset()
+            self.refresh()
+
+    def close(self):
+        self._unmap()
+
+
+class _LinkedTable(_MappedTable):
+    # a table with an append only file next to it that its slots point
+    # into. the header's table specific field is how far that file has been
+    # committed, LINKED_UNIT bytes at a time. records are written at their
+    # place rather than appended, so any left past the committed end by an
+    # update that never finished are simply written over
+    LINKED_SUFFIX = None
+    LINKED_UNIT = 1
+
+    def __init__(self, chain_path):
+        super().__init__(chain_path)
+        self.linked_path = chain_path + self.LINKED_SUFFIX
+        self._linked = None
+
+    def _map_file(self):
+        super()._map_file()
+        if self._linked is None:
+            self._linked = os.fdopen(os.open(self.linked_path, os.O_RDWR | os.O_CREAT, 0o666), "r+b")
+
+    def _validate(self):
+        size = os.fstat(self._linked.fileno()).st_size
+        if size < self.extra * self.LINKED_UNIT:
+            self.close()
+            raise ChainError(f"index {self.linked_path} is out of step with {self.path}")
+
+    def _sync(self):
+        super()._sync()
+        try:
+            replaced = os.stat(self.linked_path).st_ino != os.fstat(self._linked.fileno()).st_ino
+        except FileNotFoundError:
+            replaced = True
+        if replaced:
+            self._linked.close()
+            self._linked = None
+            self._map_file()
+
+    def _create(self, capacity, path=None):
+        if path is None:
+            if self._linked is not None:
+                self._linked.close()
+                self._linked = None
+            open(self.linked_path + ".tmp", "wb").close()
+            os.replace(self.linked_path + ".tmp", self.linked_path)
+        super()._create(capacity, path)
+
+    def commit(self, chain_size, sync=True):
+        if sync:
+            os.fsync(self._linked.fileno())
+        super().commit(chain_size, sync)
+
+    def close(self):
+        super().close()
+        if self._linked is not None:
+            self._linked.close()
+            self._linked = None
+
+
+class ItemIndex(_LinkedTable):
+    # item id -> (case id, current state, owner, offset of the item's latest
+    # block), a snapshot of where every item stands as of the chain size in
+    # the header. refresh moves it on by replaying only the blocks after
+    # that, so checkout, checkin, remove and status never replay the chain.
+    #
+    # owners are only set by RELEASED and have no fixed size, they go in
+    # the linked file as (length, utf-8) records and a slot points at its
+    # item's one, 0 for none
+    SUFFIX = ITEM_INDEX_SUFFIX
+    MAGIC = b"BCIX"
+    SLOT = struct.Struct("<I B 3x Q 16s Q")
+    LINKED_SUFFIX = ITEM_OWNERS_SUFFIX
+    OWNER = struct.Struct("<I")
+    # the id and state code of a slot, the rest skipped
+    ID_CODE = struct.Struct("<I B 35x")
+
+    @property
+    def filtered(self):
+        # whether the item filter should be asked before this index, see
+        # FILTER_MIN_INDEX_BYTES
+        return self.capacity * self.SLOT.size >= FILTER_MIN_INDEX_BYTES
+
+    def _encode_key(self, item_id):
+        return item_id
+
+    def _decode_key(self, item_id):
+        return item_id
+
+    def get(self, item_id):
+        # (offset of the latest block, state) or None if the item was never added
+        fields = self._find(item_id)[1]
+        if fields is None:
+            return None
+        return fields[2], CODE_STATES[fields[1]]
+
+    def status(self, item_id):
+        # (case id, state, owner, offset of the latest block) or None if the
+        # item was never added. owner is None unless the item was RELEASED
+        fields = self._find(item_id)[1]
+        if fields is None:
+            return None
+        return self._status(fields)
+
+    def _status(self, fields):
+        _, code, offset, case_id, owner_at = fields
+        return int.from_bytes(case_id, "little"), CODE_STATES[code], self._owner(owner_at), offset
+
+    def _owner(self, owner_at):
+        if not owner_at:
+            return None
+        fd = self._linked.fileno()
+        length = self.OWNER.unpack(os.pread(fd, self.OWNER.size, owner_at - 1))[0]
+        return os.pread(fd, length, owner_at - 1 + self.OWNER.size).decode(errors="replace")
+
+    def __contains__(self, item_id):
+        return self._find(item_id)[1] is not None
+
+    def record(self, offset, case_id, item_id, state):
+        code = STATE_CODES.get(state)
+        if code is None:
+            # a state the spec does not have, which verify reports. it does
+            # not move the item, the same as verify's state checks
+            return
+        owner_at = 0
+        if state == "RELEASED":
+            owner_at = self._add_owner(offset)
+        self._store(item_id, code, offset, case_id.to_bytes(CASE_ID_SIZE, "little"), owner_at)
+
+    def _add_owner(self, offset):
+        # the owner is the data of the block, which is on disk by the time
+        # it is recorded. RELEASED is rare enough that reading it back costs
+        # nothing worth keeping the data around for
+        with open(self.chain_path, "rb") as f:
+            fd = f.fileno()
+            length = self.OWNER.unpack(os.pread(fd, self.OWNER.size, offset + DATA_LENGTH_OFFSET))[0]
+            owner = os.pread(fd, length, offset + HEADER_SIZE).rstrip(b"\0")
+        os.pwrite(self._linked.fileno(), self.OWNER.pack(len(owner)) + owner, self.extra)
+        owner_at = self.extra + 1
+        self.extra += self.OWNER.size + len(owner)
+        return owner_at
+
+    def items(self):
+        # (item id, case id, state, owner, offset of the latest block) of
+        # every item, in no particular order
+        for fields in self._slots():
+            yield (fields[0],) + self._status(fields)
+
+    def item_ids(self):
+        # every item id, in no particular order
+        with memoryview(self._map) as view:
+            return [item_id for item_id, code in self.ID_CODE.iter_unpack(view[INDEX_HEADER.size:]) if code]
+
+    def case_items(self, case_id):
+        # the same for one case's items. the snapshot is keyed by item, so
+        # this reads every slot, but only the ones of the case are decoded
+        packed = case_id.to_bytes(CASE_ID_SIZE, "little")
+        for fields in self.SLOT.iter_unpack(memoryview(self._map)[INDEX_HEADER.size:]):
+            if fields[3] == packed and fields[1]:
+                yield (fields[0],) + self._status(fields)
+
+
+class ItemFilter(_MappedTable):
+    # a bloom filter of every item id, so an add of new items can tell
+    # they are new without going to the item index, which at tens of
+    # millions of items no longer stays in memory. "no" is certain, "maybe"
+    # still needs the index.
+    #
+    # it is a blocked filter: every item's 7 bits fall in one 64 byte
+    # slot, so a check only touches one cache line of the map.
+    # the header's slot count is the number of slots and its used count is
+    # how many items went in. once that passes FILTER_ITEMS_PER_SLOT per slot
+    # the filter is built again four times the size from the item index's
+    # slots. bits are only ever set, so a crash part way through an update
+    # can only leave some set early, which replaying the tail sets again
+    # anyway
+    SUFFIX = ITEM_FILTER_SUFFIX
+    MAGIC = b"BCBF"
+    SLOT = struct.Struct("64s")
+
+    def _place(self, item_id):
+        # (slot offset, bits) of an item. one multiply spreads the id over
+        # the slots, a second mixes it into bits whose 7 lowest 9 bit
+        # groups are the item's bit positions in the slot
+        mixed = (item_id * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        slot = (mixed >> 32) * self.capacity >> 32
+        return INDEX_HEADER.size + slot * 64, (mixed ^ mixed >> 29) * 0xBF58476D1CE4E5B9
+
+    @staticmethod
+    def _mask(bits):
+        return (1 << (bits & 511) | 1 << (bits >> 9 & 511) | 1 << (bits >> 18 & 511) | 1 << (bits >> 27 & 511)
+                | 1 << (bits >> 36 & 511) | 1 << (bits >> 45 & 511) | 1 << (bits >> 54 & 511))
+
+    def __contains__(self, item_id):
+        # tests the bits one byte at a time and stops at the first clear
+        # one, which for an id that was never added, what an add asks
+        # about, is most often the first or second. written out rather
+        # than looped, this runs once per id checked
+        pos, bits = self._place(item_id)
+        buf = self._map
+        bit = bits & 511
+        if not buf[pos + (bit >> 3)] >> (bit & 7) & 1:
+            return False
+        bit = bits >> 9 & 511
+        if not buf[pos + (bit >> 3)] >> (bit & 7) & 1:
+            return False
+        bit = bits >> 18 & 511
+        if not buf[pos + (bit >> 3)] >> (bit & 7) & 1:
+            return False
+        bit = bits >> 27 & 511
+        if not buf[pos + (bit >> 3)] >> (bit & 7) & 1:
+            return False
+        bit = bits >> 36 & 511
+        if not buf[pos + (bit >> 3)] >> (bit & 7) & 1:
+            return False
+        bit = bits >> 45 & 511
+        if not buf[pos + (bit >> 3)] >> (bit & 7) & 1:
+            return False
+        bit = bits >> 54 & 511
+        return buf[pos + (bit >> 3)] >> (bit & 7) & 1 == 1
+
+    def add(self, item_id):
+        pos, bits = self._place(item_id)
+        mask = self._mask(bits)
+        slot = int.from_bytes(self._map[pos:pos + 64], "little")
+        if slot & mask != mask:
+            self._map[pos:pos + 64] = (slot | mask).to_bytes(64, "little")
+            self.count += 1
+
+    def record(self, offset, case_id, item_id, state):
+        self.add(item_id)
+
+    def commit(self, chain_size, sync=True):
+        if self.count > self.capacity * FILTER_ITEMS_PER_SLOT:
+            self._grow_to(chain_size)
+        super().commit(chain_size, sync)
+
+    def _grow_to(self, chain_size):
+        # a filter four times the size, filled from the item index, which
+        # commits ahead of the filter, and from the chain past what the
+        # index covers. its header covers nothing until the commit that
+        # follows, so dying half way only means it is filled again
+        capacity = self.capacity * 4
+        while self.count > capacity * FILTER_ITEMS_PER_SLOT:
+            capacity *= 4
+        tmp_path = self.path + ".tmp"
+        self._create(capacity, tmp_path)
+        self._unmap()
+        os.replace(tmp_path, self.path)
+        self._map_file()
+        item_ids, start = [], 0
+        items = ItemIndex(self.chain_path)
+        try:
+            items._map_file()
+            if items.chain_size <= chain_size:
+                item_ids, start = items.item_ids(), items.chain_size
+        except (OSError, ChainError):
+            # no index to take them from, the whole chain is read
+            pass
+        finally:
+            items.close()
+        if start < chain_size:
+            with BlockReader(self.chain_path) as reader:
+                for block in reader.iter_from(start):
+                    if block.offset >= chain_size:
+                        break
+                    if block.offset:
+                        item_ids.append(block.item_id)
+                block = None
+        self._fill(item_ids)
+
+    def _fill(self, item_ids):
+        # sets the bits of every id in a filter that was just created. the
+        # masks are gathered per slot first so each slot is written once
+        masks = {}
+        for item_id in item_ids:
+            pos, bits = self._place(item_id)
+            mask = self._mask(bits)
+            slot = masks.get(pos, 0)
+            if slot & mask != mask:
+                masks[pos] = slot | mask
+                self.count += 1
+        for pos, slot in masks.items():
+            self._map[pos:pos + 64] = slot.to_bytes(64, "little")
+
+    def _recount(self):
+        # items that went in cannot be told apart from the bits, the
+        # header's count stands
+        pass
+
+    def reset(self):
+        self.close()
+        self._create(FILTER_INITIAL_SLOTS)
+
+
+class CaseIndex(_LinkedTable):
+    # case id -> every block offset for that case
+    #
+    # offsets live in the linked postings file, one (block offset, previous
+    # posting + 1) record per block, so each case is a linked list running
+    # newest to oldest. a slot holds the case's newest posting and its
+    # block count, and the header's table specific field is how many
+    # postings have been committed
+    SUFFIX = CASE_INDEX_SUFFIX
+    MAGIC = b"BCCX"
+    SLOT = struct.Struct("<16s B 7x Q Q")
+    POSTING = struct.Struct("<Q Q")
+    LINKED_SUFFIX = CASE_POSTINGS_SUFFIX
+    LINKED_UNIT = POSTING.size
+
+    def _encode_key(self, case_id):
+        return case_id.to_bytes(CASE_ID_SIZE, "little")
+
+    def _decode_key(self, packed):
+        return int.from_bytes(packed, "little")
+
+    def record(self, offset, case_id, item_id, state):
+        fields = self._find(case_id)[1]
+        head, count = (fields[2], fields[3]) if fields is not None else (0, 0)
+        os.pwrite(self._linked.fileno(), self.POSTING.pack(offset, head), self.extra * self.POSTING.size)
+        self.extra += 1
+        self._store(case_id, 1, self.extra, count + 1)
+
+    def _recount(self):
+        # an update cut short can leave a slot pointing at postings past the
+        # committed ones, for blocks the replay is about to record again.
+        # each such case is wound back to its newest committed posting
+        # first, or the replayed posting would link to itself and the count
+        # would take those blocks twice
+        fd = self._linked.fileno()
+        size = self.POSTING.size
+        for slot in range(self.capacity):
+            pos = INDEX_HEADER.size + slot * self.SLOT.size
+            packed, used, head, count = self.SLOT.unpack_from(self._map, pos)
+            if not used or head <= self.extra:
+                continue
+            while head > self.extra:
+                raw = os.pread(fd, size, (head - 1) * size)
+                if len(raw) != size:
+                    # the postings never made it to disk, start over
+                    self.reset()
+                    return
+                head = self.POSTING.unpack(raw)[1]
+                count -= 1
+            self.SLOT.pack_into(self._map, pos, packed, used, head, count)
+        super()._recount()
+
+    def count_for(self, case_id):
+        fields = self._find(case_id)[1]
+        return fields[3] if fields is not None else 0
+
+    def iter_offsets_reverse(self, case_id):
+        # newest first, reading one posting per block of the case
+        fields = self._find(case_id)[1]
+        link = fields[2] if fields is not None else 0
+        fd = self._linked.fileno()
+        while link:
+            offset, link = self.POSTING.unpack(os.pread(fd, self.POSTING.size, (link - 1) * self.POSTING.size))
+            yield offset
+
+    def offsets(self, case_id):
+        # oldest first
+        offsets = list(self.iter_offsets_reverse(case_id))
+        offsets.reverse()
+        return offsets
+
+    def cases(self):
+        for packed, _, head, count in self._slots():
+            yield self._decode_key(packed), count
+
+
+class AppendOnlyFile:
+    # a sidecar that only ever grows: a header of magic, version and chain
+    # bytes covered followed by subclass fields, then entries that are
+    # written past the committed ones first, with the header moving on
+    # last. anything past what the header counts is written over by the
+    # next commit. subclasses set SUFFIX, MAGIC and HEADER and fill in
+    # _clear, _load_header, _header_fields, _replay, record and commit
+    SUFFIX = None
+    MAGIC = None
+    HEADER = None
+
+    def __init__(self, chain_path):
+        self.chain_path = chain_path
+        self.path = chain_path + self.SUFFIX
+        self.chain_size = 0
+        self._file = None
+        self._clear()
+
+    @classmethod
+    def open(cls, chain_path):
+        sidecar = cls(chain_path)
+        with ChainLock(chain_path):
+            sidecar._load()
+            sidecar.refresh()
+        return sidecar
+
+    def _clear(self):
+        # the in memory state of an empty file
+        pass
+
+    def _load(self):
+        try:
+            self._file = open(self.path, "r+b")
+        except FileNotFoundError:
+            self.reset()
+            return
+        self._clear()
+        if not self._read_header():
+            self.reset()
+
+    def _read_header(self):
+        # false if the file is not a valid one of ours
+        header = os.pread(self._file.fileno(), self.HEADER.size, 0)
+        if len(header) != self.HEADER.size:
+            return False
+        magic, version, chain_size, *fields = self.HEADER.unpack(header)
+        if magic != self.MAGIC or version != INDEX_VERSION:
+            return False
+        if not self._load_header(fields, os.fstat(self._file.fileno()).st_size):
+            return False
+        self.chain_size = chain_size
+        return True
+
+    def _load_header(self, fields, file_size):
+        # take in the subclass fields, false if the file is too short for them
+        return True
+
+    def _header_fields(self):
+        return ()
+
+    def _write_header(self, sync=False):
+        self._file.seek(0)
+        self._file.write(self.HEADER.pack(self.MAGIC, INDEX_VERSION, self.chain_size, *self._header_fields()))
+        self._file.flush()
+        if sync:
+            os.fsync(self._file.fileno())
+
+    def _sync(self):
+        # take in what other processes committed, a reset renamed a new file over ours
+        try:
+            replaced = self._file is None or os.stat(self.path).st_ino != os.fstat(self._file.fileno()).st_ino
+        except FileNotFoundError:
+            replaced = True
+        if replaced:
+            self.close()
+            self._load()
+        elif not self._read_header():
+            self.reset()
+
+    def _replay(self, reader):
+        # take in the blocks from chain_size on, before the commit that
+        # follows. unlike the tables this includes the INITIAL block
+        raise NotImplementedError
+
+    def refresh(self):
+        # replay any blocks appended since the file was last committed
+        with ChainLock(self.chain_path):
+            if not os.path.exists(self.chain_path):
+                if self.chain_size:
+                    self.reset()
+                return
+            self._sync()
+            if os.stat(self.chain_path).st_size == self.chain_size:
+                # nothing new, which is what every append finds
+                return
+            with BlockReader(self.chain_path) as reader:
+                if reader.size < self.chain_size:
+                    self.reset()
+                if reader.size == self.chain_size:
+                    return
+                self._replay(reader)
+                self.commit(reader.size)
+
+    def reset(self):
+        self.close()
+        with open(self.path + ".tmp", "wb"):
+            pass
+        os.replace(self.path + ".tmp", self.path)
+        self._file = open(self.path, "r+b")
+        self.chain_size = 0
+        self._clear()
+        self.commit(0)
+
+    def rebuild(self):
+        with ChainLock(self.chain_path):
+            self.reset()
+            self.refresh()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class BlockOffsets(AppendOnlyFile):
+    # start offset of every block in chain order, kept as <chain>.offsets.
+    # the chain format has no back pointers, so this is what lets a reader
+    # start at the tail and walk backwards one block at a time
+    SUFFIX = BLOCK_OFFSETS_SUFFIX
+    MAGIC = b"BCOF"
+    # magic, version, chain bytes covered, committed block count
+    HEADER = struct.Struct("<4s I Q Q")
+    ENTRY = struct.Struct("<Q")
+    # entries read per pread when walking backwards
+    CHUNK = 512
+
+    def _clear(self):
+        self.count = 0
+        self._pending = []
+
+    def _load_header(self, fields, file_size):
+        count, = fields
+        if file_size < self.HEADER.size + count * self.ENTRY.size:
+            return False
+        self.count = count
+        return True
+
+    def _header_fields(self):
+        return (self.count,)
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        raw = os.pread(self._file.fileno(), self.ENTRY.size, self.HEADER.size + i * self.ENTRY.size)
+        return self.ENTRY.unpack(raw)[0]
+
+    def index_of(self, offset):
+        # number of the block starting at offset, by binary search
+        low, high = 0, self.count
+        while low < high:
+            mid = (low + high) // 2
+            found = self[mid]
+            if found == offset:
+                return mid
+            if found < offset:
+                low = mid + 1
+            else:
+                high = mid
+        raise ChainError(f"no block starts at offset {offset}")
+
+    def iter_reverse(self, start=0, end=None):
+        # newest first, reading the offsets a chunk at a time from the end.
+        # start and end pick out blocks by number, the way a slice would
+        first = start
+        end = self.count if end is None else min(end, self.count)
+        while end > first:
+            start = max(end - self.CHUNK, first)
+            raw = os.pread(self._file.fileno(), (end - start) * self.ENTRY.size,
+                           self.HEADER.size + start * self.ENTRY.size)
+            chunk = [offset for offset, in self.ENTRY.iter_unpack(raw)]
+            yield from reversed(chunk)
+            end = start
+
+    def record(self, offset, case_id, item_id, state):
+        self._pending.append(offset)
+
+    def _replay(self, reader):
+        self._pending.extend(reader.iter_offsets(self.chain_size))
+
+    def commit(self, chain_size, sync=True):
+        if self._pending:
+            self._file.seek(self.HEADER.size + self.count * self.ENTRY.size)
+            self._file.write(b"".join(self.ENTRY.pack(offset) for offset in self._pending))
+            self._file.flush()
+            if sync:
+                os.fsync(self._file.fileno())
+            self.count += len(self._pending)
+            self._pending = []
+        self.chain_size = chain_size
+        self._write_header(sync)
+
+
+class Segment:
+    # one sealed stretch of the chain, a whole number of blocks that no
+    # append will ever touch again. number counts from 0 in chain order
+    __slots__ = ("number", "start", "end", "last", "first_block", "blocks", "first_hash", "last_hash",
+                 "min_time", "max_time", "min_case", "max_case", "min_item", "max_item")
+
+    def __init__(self, number, start, end, last, first_block, blocks, first_hash, last_hash,
+                 min_time, max_time, min_case, max_case, min_item, max_item):
+        self.number = number
+        self.start = start
+        self.end = end
+        # offset of the segment's last block
+        self.last = last
+        self.first_block = first_block
+        self.blocks = blocks
+        self.first_hash = first_hash
+        self.last_hash = last_hash
+        self.min_time = min_time
+        self.max_time = max_time
+        self.min_case = min_case
+        self.max_case = max_case
+        self.min_item = min_item
+        self.max_item = max_item
+
+    def may_hold(self, case_id=None, item_id=None):
+        # false only if no block in the segment can have this case and item
+        return ((case_id is None or self.min_case <= case_id <= self.max_case)
+                and (item_id is None or self.min_item <= item_id <= self.max_item))
+
+
+class SegmentManifest(AppendOnlyFile):
+    # the chain cut into numbered segments, kept as <chain>.manifest. once
+    # the part past the last sealed segment reaches SEGMENT_BLOCKS blocks or
+    # SEGMENT_BYTES bytes it is sealed, and the manifest records its first
+    # and last hash, its block count and the range of timestamps, case ids
+    # and item ids in it. the chain itself stays one file in the usual
+    # format, a sealed segment is a byte range of it that never changes
+    # again. so a backup only has to copy what is past the last one it
+    # saved, a log for one item can skip every segment that cannot hold it
+    # and verify --incremental only has to look at the ends of the sealed
+    # segments
+    SUFFIX = SEGMENT_MANIFEST_SUFFIX
+    MAGIC = b"BCSG"
+    # magic, version, chain bytes covered, sealed segments, start of the
+    # open segment, blocks in it, the block and byte limits it is sealed at
+    HEADER = struct.Struct("<4s I Q Q Q Q Q Q")
+    # start, end, last block offset, first block number, block count,
+    # first hash, last hash, min and max timestamp, case id and item id
+    ENTRY = struct.Struct(f"<Q Q Q Q Q {HASH_SIZE}s {HASH_SIZE}s d d {CASE_ID_SIZE}s {CASE_ID_SIZE}s I I")
+
+    def _clear(self):
+        self.segments = []
+        self.open_start = 0
+        self.open_blocks = 0
+        self.max_blocks = SEGMENT_BLOCKS
+        self.max_bytes = SEGMENT_BYTES
+        self._pending = 0
+
+    def _load_header(self, fields, file_size):
+        # sealed segments never change, so only the ones committed since
+        # the last read are loaded
+        count, open_start, open_blocks, max_blocks, max_bytes = fields
+        if file_size < self.HEADER.size + count * self.ENTRY.size or count < len(self.segments):
+            return False
+        if count > len(self.segments):
+            raw = os.pread(self._file.fileno(), (count - len(self.segments)) * self.ENTRY.size,
+                           self.HEADER.size + len(self.segments) * self.ENTRY.size)
+            for entry in self.ENTRY.iter_unpack(raw):
+                self.segments.append(self._decode(len(self.segments), entry))
+        self.open_start, self.open_blocks = open_start, open_blocks
+        self.max_blocks, self.max_bytes = max_blocks, max_bytes
+        return True
+
+    def _header_fields(self):
+        return len(self.segments), self.open_start, self.open_blocks, self.max_blocks, self.max_bytes
+
+    def _decode(self, number, fields):
+        start, end, last, first_block, blocks, first_hash, last_hash, min_time, max_time, min_case, max_case, \
+            min_item, max_item = fields
+        return Segment(number, start, end, last, first_block, blocks, first_hash, last_hash, min_time, max_time,
+                       int.from_bytes(min_case, "little"), int.from_bytes(max_case, "little"), min_item, max_item)
+
+    def _encode(self, segment):
+        return self.ENTRY.pack(segment.start, segment.end, segment.last, segment.first_block, segment.blocks,
+                               segment.first_hash, segment.last_hash, segment.min_time, segment.max_time,
+                               segment.min_case.to_bytes(CASE_ID_SIZE, "little"),
+                               segment.max_case.to_bytes(CASE_ID_SIZE, "little"), segment.min_item, segment.max_item)
+
+    @property
+    def open_first_block(self):
+        # number of the first block past the sealed segments
+        return self.segments[-1].first_block + self.segments[-1].blocks if self.segments else 0
+
+    def ranges(self, case_id=None, item_id=None):
+        # (start, end, first block, end block) of the stretches of the chain
+        # that may hold blocks of this case and item, oldest first. sealed
+        # segments next to each other are merged, and the last stretch runs
+        # on past the sealed ones with None for its end and end block
+        ranges = []
+        for segment in self.segments:
+            if not segment.may_hold(case_id, item_id):
+                continue
+            if ranges and ranges[-1][1] == segment.start:
+                ranges[-1][1] = segment.end
+                ranges[-1][3] = segment.first_block + segment.blocks
+            else:
+                ranges.append([segment.start, segment.end, segment.first_block, segment.first_block + segment.blocks])
+        if ranges and ranges[-1][1] == self.open_start:
+            ranges[-1][1] = ranges[-1][3] = None
+        else:
+            ranges.append([self.open_start, None, self.open_first_block, None])
+        return ranges
+
+    def record(self, offset, case_id, item_id, state):
+        self._pending += 1
+
+    def commit(self, chain_size, sync=True):
+        # a header lost in a crash only means the next refresh counts those
+        # blocks again, so it is only fsynced along with a seal
+        self.open_blocks += self._pending
+        self._pending = 0
+        self.chain_size = chain_size
+        sealed = self.open_blocks >= self.max_blocks or chain_size - self.open_start >= self.max_bytes
+        if sealed:
+            self._seal()
+        self._write_header(sync and sealed)
+
+    def _seal(self):
+        # cut everything the open segment holds into sealed segments, as
+        # many as the limits call for. this is the one pass over its blocks
+        # the manifest makes, once per segment
+        sealed = []
+        first_block = self.open_first_block
+        with BlockReader(self.chain_path) as reader:
+            segment = None
+            for block in reader.iter_from(self.open_start):
+                if block.offset >= self.chain_size:
+                    break
+                case_id, item_id, timestamp = block.case_id, block.item_id, block.timestamp
+                if segment is None:
+                    segment = Segment(len(self.segments) + len(sealed), block.offset, 0, 0, first_block, 0,
+                                      block.hash(), None, timestamp, timestamp, case_id, case_id, item_id, item_id)
+                segment.blocks += 1
+                segment.min_time = min(segment.min_time, timestamp)
+                segment.max_time = max(segment.max_time, timestamp)
+                segment.min_case = min(segment.min_case, case_id)
+                segment.max_case = max(segment.max_case, case_id)
+                segment.min_item = min(segment.min_item, item_id)
+                segment.max_item = max(segment.max_item, item_id)
+                if segment.blocks >= self.max_blocks or block.end - segment.start >= self.max_bytes:
+                    segment.end, segment.last, segment.last_hash = block.end, block.offset, block.hash()
+                    sealed.append(segment)
+                    first_block += segment.blocks
+                    segment = None
+            block = None
+        if not sealed:
+            return
+        self._file.seek(self.HEADER.size + len(self.segments) * self.ENTRY.size)
+        self._file.write(b"".join(self._encode(segment) for segment in sealed))
+        self._file.flush()
+        # the entries have to be down before a header that counts them
+        os.fsync(self._file.fileno())
+        self.segments.extend(sealed)
+        self.open_blocks -= sum(segment.blocks for segment in sealed)
+        self.open_start = sealed[-1].end
+
+    def _replay(self, reader):
+        for _ in reader.iter_offsets(self.chain_size):
+            self._pending += 1
+
+
+def read_segments(chain_path):
+    # the sealed segments as last committed, without taking the lock or
+    # bringing the manifest up to date. [] if there is no usable manifest
+    manifest = SegmentManifest(chain_path)
+    try:
+        manifest._file = open(manifest.path, "rb")
+    except FileNotFoundError:
+        return []
+    try:
+        return manifest.segments if manifest._read_header() else []
+    finally:
+        manifest.close()
@@ -0,0 +1,71 @@
+import fcntl
+import os
+import threading
+
+
+# advisory locks on <chain>.lock, taken by every process that touches the
+# chain. writers hold it exclusively from reading the tail until the
+# sidecars are committed, so appends from two processes can never chain
+# off the same parent. readers hold it shared just long enough to size the
+# chain, which keeps a half written batch out of their view.
+#
+# flock locks belong to an open file, so a second open in the same thread
+# would deadlock against the first. locks are counted per thread instead and
+# nested holders share one open file. each thread opens its own, so threads
+# exclude each other the same way processes do
+LOCK_SUFFIX = ".lock"
+
+# (lock path, thread id) -> [open file, depth, exclusive]
+_held = {}
+
+
+class ChainLock:
+    def __init__(self, chain_path, exclusive=True):
+        self.path = os.path.abspath(chain_path) + LOCK_SUFFIX
+        self.exclusive = exclusive
+        self._key = (self.path, threading.get_ident())
+
+    def acquire(self, blocking=True):
+        # returns False if blocking is off and another process has the lock
+        mode = fcntl.LOCK_EX if self.exclusive else fcntl.LOCK_SH
+        if not blocking:
+            mode |= fcntl.LOCK_NB
+        held = _held.get(self._key)
+        if held is not None:
+            if self.exclusive and not held[2]:
+                # flock upgrades in place, though not atomically: another
+                # writer may get in between
+                try:
+                    fcntl.flock(held[0].fileno(), mode)
+                except BlockingIOError:
+                    return False
+                held[2] = True
+            held[1] += 1
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+        f = os.fdopen(fd, "r+b")
+        try:
+            fcntl.flock(fd, mode)
+        except BlockingIOError:
+            f.close()
+            return False
+        except BaseException:
+            f.close()
+            raise
+        _held[self._key] = [f, 1, self.exclusive]
+        return True
+
+    def release(self):
+        held = _held[self._key]
+        held[1] -= 1
+        if held[1] == 0:
+            del _held[self._key]
+            # closing the file drops the lock
+            held[0].close()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
@@ -0,0 +1,192 @@
+import hashlib
+import os
+import struct
+
+from block import HASH_SIZE, ChainError, chain_hash
+from index import AppendOnlyFile
+
+
+# a merkle tree over the block hashes, kept as <chain>.merkle, so a block
+# can be shown to be in the chain with log2(n) hashes instead of the whole
+# chain before it. the tree is the one from rfc 6962 (certificate
+# transparency): a leaf is sha256(0x00 + block hash), a node is
+# sha256(0x01 + left + right), and a tree of n leaves splits at the largest
+# power of two below n. the root of the first n blocks never changes as the
+# chain grows, so a root handed out once can check any later proof for a
+# tree at least that big. the block hashes are whichever the chain is
+# linked with (see block.HASHES), the tree's own are always sha256.
+#
+# only complete subtrees are stored, in post order, which makes the file
+# append only: adding a leaf writes it and then every subtree it completes.
+# hashes over the ragged right edge are worked out from those when asked
+# for
+MERKLE_SUFFIX = ".merkle"
+
+LEAF_PREFIX = b"\x00"
+NODE_PREFIX = b"\x01"
+
+
+def leaf_hash(block_digest):
+    return hashlib.sha256(LEAF_PREFIX + block_digest).digest()
+
+
+def node_hash(left, right):
+    return hashlib.sha256(NODE_PREFIX + left + right).digest()
+
+
+def _nodes_before(leaves):
+    # nodes stored for a tree of this many leaves
+    return 2 * leaves - bin(leaves).count("1")
+
+
+def _position(height, index):
+    # where the complete subtree of 2**height leaves starting at leaf
+    # index * 2**height is stored
+    return _nodes_before(index << height) + (2 << height) - 2
+
+
+def _split(size):
+    # largest power of two below size
+    return 1 << (size - 1).bit_length() - 1
+
+
+def root_from_path(digest, index, size, path):
+    # the root a proof leads to from a block hash, the leaf's position and
+    # the tree size, or None if the path has the wrong length for them.
+    # this is the check from rfc 9162 section 2.1.3.2
+    if not 0 <= index < size:
+        return None
+    node = leaf_hash(digest)
+    last = size - 1
+    for sibling in path:
+        if last == 0:
+            return None
+        if index & 1 or index == last:
+            node = node_hash(sibling, node)
+            if not index & 1:
+                while index and not index & 1:
+                    index >>= 1
+                    last >>= 1
+        else:
+            node = node_hash(node, sibling)
+        index >>= 1
+        last >>= 1
+    return node if last == 0 else None
+
+
+class MerkleTree(AppendOnlyFile):
+    SUFFIX = MERKLE_SUFFIX
+    MAGIC = b"BCMK"
+    # magic, version, chain bytes covered, committed leaf count
+    HEADER = struct.Struct("<4s I Q Q")
+
+    def _clear(self):
+        self.leaves = 0
+        # block offsets recorded since the last commit
+        self._pending = []
+        # nodes computed past the committed ones, in the order they are
+        # stored, and how many of them are leaves
+        self._nodes = []
+        self._added = 0
+
+    def _load_header(self, fields, file_size):
+        leaves, = fields
+        if file_size < self.HEADER.size + _nodes_before(leaves) * HASH_SIZE:
+            return False
+        self.leaves = leaves
+        return True
+
+    def _header_fields(self):
+        return (self.leaves,)
+
+    def _node(self, position):
+        committed = _nodes_before(self.leaves)
+        if position >= committed:
+            return self._nodes[position - committed]
+        raw = os.pread(self._file.fileno(), HASH_SIZE, self.HEADER.size + position * HASH_SIZE)
+        if len(raw) != HASH_SIZE:
+            raise ChainError(f"merkle tree {self.path} is truncated")
+        return raw
+
+    def _add(self, digest):
+        node = leaf_hash(digest)
+        self._nodes.append(node)
+        leaves = self.leaves + self._added
+        self._added += 1
+        height = 0
+        # each trailing one bit of the new leaf's index closes a subtree
+        while leaves >> height & 1:
+            left = self._node(_position(height, (leaves >> height) - 1))
+            node = node_hash(left, node)
+            self._nodes.append(node)
+            height += 1
+
+    def _subtree(self, start, end):
+        # root of the leaves in [start, end). the ranges a proof asks for
+        # always start on a multiple of their largest power of two, so they
+        # break down into stored subtrees
+        size = end - start
+        if size & (size - 1) == 0:
+            height = size.bit_length() - 1
+            return self._node(_position(height, start >> height))
+        k = _split(size)
+        return node_hash(self._subtree(start, start + k), self._subtree(start + k, end))
+
+    def root(self, size=None):
+        # root of the tree over the first size blocks, all of them if None
+        size = self.leaves if size is None else size
+        if not 0 < size <= self.leaves:
+            raise ChainError(f"the chain has {self.leaves} blocks, not {size}")
+        return self._subtree(0, size)
+
+    def proof(self, index, size=None):
+        # the sibling hashes from block number index up to the root of the
+        # tree over the first size blocks, lowest first
+        size = self.leaves if size is None else size
+        if not 0 <= index < size <= self.leaves:
+            raise ChainError(f"block {index} is not in a tree of {size} blocks")
+        path = []
+        start, end = 0, size
+        # rfc 6962 section 2.1.1, walked from the root down
+        while end - start > 1:
+            k = _split(end - start)
+            if index < start + k:
+                path.append(self._subtree(start + k, end))
+                end = start + k
+            else:
+                path.append(self._subtree(start, start + k))
+                start += k
+        path.reverse()
+        return path
+
+    def record(self, offset, case_id, item_id, state):
+        self._pending.append(offset)
+
+    def commit(self, chain_size, sync=True):
+        if self._pending:
+            # the blocks were just written, hashing them again reads them
+            # back from the page cache
+            base = self._pending[0]
+            with open(self.chain_path, "rb") as f:
+                block_hash = chain_hash(f.fileno())
+                raw = memoryview(os.pread(f.fileno(), chain_size - base, base))
+            for start, end in zip(self._pending, self._pending[1:] + [chain_size]):
+                self._add(block_hash(raw[start - base:end - base]))
+            self._pending = []
+        if self._nodes:
+            self._file.seek(self.HEADER.size + _nodes_before(self.leaves) * HASH_SIZE)
+            self._file.write(b"".join(self._nodes))
+            self._file.flush()
+            if sync:
+                os.fsync(self._file.fileno())
+            self.leaves += self._added
+            self._added = 0
+            self._nodes = []
+        # a header that is lost in a crash only means the next refresh
+        # hashes those blocks again, so it is not worth an fsync of its own
+        self.chain_size = chain_size
+        self._write_header()
+
+    def _replay(self, reader):
+        for block in reader.iter_from(self.chain_size):
+            self._add(block.hash())
@@ -0,0 +1,139 @@
+import os
+import sys
+import time
+
+# phase timings for one cli call, turned on by --profile or BCHOH_PROFILE.
+#
+# code marks the interesting parts with `with profiling.phase("fsync"):`.
+# while profiling is off that hands back a shared no-op context manager,
+# so the marks cost next to nothing. the short commands import this too,
+# so nothing heavier than time is imported up front. phases can nest, so
+# they need not add up to the total. the report goes to stderr as one json object:
+#
+#   {"command": "checkin", "wall_ms": ..., "cpu_ms": ...,
+#    "phases": {"startup": {"wall_ms": ..., "cpu_ms": ..., "calls": 1}, ...},
+#    "bytes_read": ..., "bytes_written": ..., "page_faults": ...,
+#    "blocks_touched": ...}
+#
+# bytes come from /proc/self/io and only count read and write calls.
+# reads through the chain's memory map show up as page faults instead
+enabled = False
+
+_phases = {}
+_counters = {}
+
+
+class _NoPhase:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+
+_no_phase = _NoPhase()
+
+
+class _Phase:
+    __slots__ = ("name", "wall", "cpu")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, time.perf_counter() - self.wall, time.process_time() - self.cpu)
+
+
+def phase(name):
+    return _Phase(name) if enabled else _no_phase
+
+
+def record(name, wall, cpu):
+    totals = _phases.setdefault(name, [0.0, 0.0, 0])
+    totals[0] += wall
+    totals[1] += cpu
+    totals[2] += 1
+
+
+def count(counter, n):
+    if enabled:
+        _counters[counter] = _counters.get(counter, 0) + n
+
+
+def _io():
+    # (bytes read, bytes written) through syscalls so far, zeros off linux
+    try:
+        with open("/proc/self/io") as f:
+            fields = dict(line.split(": ") for line in f.read().splitlines())
+        return int(fields["rchar"]), int(fields["wchar"])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+def _page_faults():
+    try:
+        import resource
+    except ImportError:
+        return 0
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_minflt + usage.ru_majflt
+
+
+def run(command, func, args, started=None, dump=None):
+    # calls func(args) with profiling on and reports when it returns or
+    # exits. started is the perf_counter() at entry, to time startup from,
+    # and dump a path to write cProfile stats to
+    global enabled
+    import json
+
+    # the daemon can run many profiled commands, each gets its own report
+    _phases.clear()
+    _counters.clear()
+    _counters["blocks_touched"] = 0
+    enabled = True
+    if started is not None:
+        # cpu time so far also covers the interpreter starting up
+        record("startup", time.perf_counter() - started, time.process_time())
+    read_before, written_before = _io()
+    faults_before = _page_faults()
+    wall = time.perf_counter()
+    cpu = time.process_time()
+
+    profiler = None
+    if dump:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        func(args)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(dump)
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+        read_after, written_after = _io()
+        report = {
+            "command": command,
+            "wall_ms": round(wall * 1000, 3),
+            "cpu_ms": round(cpu * 1000, 3),
+            "phases": {name: {"wall_ms": round(totals[0] * 1000, 3), "cpu_ms": round(totals[1] * 1000, 3),
+                              "calls": totals[2]}
+                       for name, totals in _phases.items()},
+            "bytes_read": read_after - read_before,
+            "bytes_written": written_after - written_before,
+            "page_faults": _page_faults() - faults_before,
+        }
+        report.update(_counters)
+        if dump:
+            report["cprofile"] = os.path.abspath(dump)
+        sys.stdout.flush()
+        print(json.dumps(report), file=sys.stderr)
+        enabled = False
@@ -0,0 +1,375 @@
+import os
+from collections import namedtuple
+from itertools import islice
+
+import profiling
+from block import (CASE_ID_LIMIT, DEFAULT_HASH, ITEM_ID_LIMIT, REMOVED_STATES, BlockDecoder, BlockReader, ChainError,
+                   chain_hash_name, item_key)
+from index import BlockOffsets, CaseIndex, ItemFilter, ItemIndex, SegmentManifest, read_segments
+from locking import ChainLock
+from merkle import MerkleTree
+from writer import append_blocks, create_chain
+
+
+# every sidecar that has to follow each append, in the order they commit:
+# the item index before the item filter, which grows from it, and the
+# offsets last
+Indexes = namedtuple("Indexes", "items cases manifest merkle item_filter offsets")
+INDEX_TYPES = Indexes(ItemIndex, CaseIndex, SegmentManifest, MerkleTree, ItemFilter, BlockOffsets)
+
+
+class ChainStore:
+    # the chain and its sidecars as a library, the cli commands are thin
+    # wrappers over it. the indexes stay open from one call to the next,
+    # and each call first takes in whatever other processes appended. the
+    # indexes are only opened once a call needs them, so verify and a plain
+    # log work on a chain they cannot follow. the writes check the item's
+    # state and raise ChainError with the message the cli prints. a store
+    # must not be shared between threads
+    #
+    #   with ChainStore.open("chain", create=True) as store:
+    #       store.add(66, [1, 2])
+    #       case_id, timestamp = store.checkout(1)
+    #       for block in store.iter_log(case_id=66, reverse=True, limit=5):
+    #           print(block.item_id, block.state)
+
+    def __init__(self, path):
+        self.path = path
+        self._indexes = None
+        # a columns.ChainColumns once keep_columns() is called
+        self.columns = None
+
+    @classmethod
+    def open(cls, path, create=False, rebuild=False, algorithm=DEFAULT_HASH):
+        # create starts a new chain with its INITIAL block if there is none,
+        # linked with algorithm, one of block.HASHES. rebuild builds the
+        # sidecars from scratch instead of trusting them
+        if not os.path.exists(path):
+            if not create:
+                raise ChainError("blockchain file not found")
+            create_chain(path, algorithm)
+        store = cls(path)
+        if rebuild:
+            try:
+                store.reindex()
+            except BaseException:
+                store.close()
+                raise
+        return store
+
+    @property
+    def indexes(self):
+        # an Indexes of one of each of INDEX_TYPES, opened on first use
+        if self._indexes is None:
+            with profiling.phase("index_open"):
+                self._indexes = Indexes._make(index_type.open(self.path) for index_type in INDEX_TYPES)
+        return self._indexes
+
+    def keep_columns(self):
+        # hold every block header in memory from now on, which pays off for
+        # a long running process that logs a lot
+        from columns import ChainColumns
+
+        self.columns = ChainColumns()
+        with self._snapshot() as reader:
+            self.columns.extend(reader)
+
+    def refresh(self):
+        # take in blocks other processes appended since the last call. the
+        # offsets are committed last, so if they cover the whole chain every
+        # index does
+        if not os.path.exists(self.path):
+            raise ChainError("blockchain file not found")
+        if self._indexes is None or os.stat(self.path).st_size == self._indexes.offsets.chain_size:
+            # indexes not opened yet are brought up to date when they are
+            return
+        with profiling.phase("index_open"):
+            for index in self.indexes:
+                index.refresh()
+
+    def _snapshot(self):
+        # a reader over the chain as it is now, sized under the lock so a
+        # batch still being written is left out
+        with ChainLock(self.path, exclusive=False):
+            return BlockReader(self.path)
+
+    def lookup(self, item_id):
+        # (case id, state) of an item, None if it was never added
+        self.refresh()
+        items = self.indexes.items
+        with profiling.phase("lookup"):
+            if items.filtered and item_id not in self.indexes.item_filter:
+                return None
+            status = items.status(item_id)
+        if status is None:
+            return None
+        return status[0], status[1]
+
+    def status(self, case_id=None, item_id=None):
+        # (item id, case id, state, owner, offset of the latest block) of
+        # one item, of every item of a case, or of every item, sorted by
+        # item id. answered from the item index alone, the chain is not read.
+        # owner is None unless the item was RELEASED
+        self.refresh()
+        items = self.indexes.items
+        with profiling.phase("lookup"):
+            if item_id is not None:
+                status = items.status(item_id)
+                if status is None or case_id is not None and status[0] != case_id:
+                    raise ChainError(f"item {item_id} not found" if case_id is None
+                                     else f"item {item_id} not found in case {case_id}")
+                return [(item_id,) + status]
+            rows = list(items.items() if case_id is None else items.case_items(case_id))
+        if not rows:
+            raise ChainError("no items found" if case_id is None else f"case {case_id} not found")
+        rows.sort()
+        return rows
+
+    def _current(self, item_id):
+        current = self.lookup(item_id)
+        if current is None:
+            raise ChainError(f"item {item_id} not found")
+        return current
+
+    def add(self, case_id, item_ids):
+        # adds new items to a case in one write and one fsync, returns their
+        # timestamps
+        item_ids = list(item_ids)
+        if len(set(item_ids)) != len(item_ids):
+            raise ChainError("the same item id was given more than once")
+        # checked before anything is queued, a block cannot hold these
+        if not 0 <= case_id < CASE_ID_LIMIT:
+            raise ChainError(f"case id {case_id} is out of range")
+        for item_id in item_ids:
+            if not 0 <= item_id < ITEM_ID_LIMIT:
+                raise ChainError(f"item id {item_id} is out of range")
+        self.refresh()
+        items, item_filter = self.indexes.items, self.indexes.item_filter
+        with profiling.phase("lookup"):
+            if items.filtered:
+                # only the ids the filter is not sure about go to the index
+                existing = [item_id for item_id in item_ids if item_id in item_filter and item_id in items]
+            else:
+                existing = [item_id for item_id in item_ids if item_id in items]
+        if existing:
+            raise ChainError(f"item {existing[0]} already exists")
+        records = [(case_id, item_id, "CHECKEDIN", b"") for item_id in item_ids]
+        return append_blocks(self.path, self.indexes, records, [None] * len(records))
+
+    def checkout(self, item_id):
+        # returns (case id, timestamp)
+        case_id, state = self._current(item_id)
+        if state != "CHECKEDIN":
+            raise ChainError("Cannot check out a checked out item. Must check it in first." if state == "CHECKEDOUT"
+                             else f"Cannot check out an item that is {state}")
+        return case_id, self._append(case_id, item_id, "CHECKEDOUT", b"", state)
+
+    def checkin(self, item_id):
+        # returns (case id, timestamp)
+        case_id, state = self._current(item_id)
+        if state != "CHECKEDOUT":
+            raise ChainError(f"Cannot check in an item that is {state}")
+        return case_id, self._append(case_id, item_id, "CHECKEDIN", b"", state)
+
+    def remove(self, item_id, reason, owner=None):
+        # reason is one of REMOVED_STATES, owner is required for RELEASED.
+        # returns (case id, timestamp)
+        reason = reason.upper()
+        if reason not in REMOVED_STATES:
+            raise ChainError(f"reason must be one of {', '.join(REMOVED_STATES)}")
+        if reason == "RELEASED" and not owner:
+            raise ChainError("owner is required when the item is RELEASED")
+        case_id, state = self._current(item_id)
+        if state != "CHECKEDIN":
+            raise ChainError(f"Cannot remove an item that is {state}, it must be CHECKEDIN")
+        data = owner.encode() + b"\0" if owner else b""
+        return case_id, self._append(case_id, item_id, reason, data, state)
+
+    def _append(self, case_id, item_id, state, data, expected):
+        return append_blocks(self.path, self.indexes, [(case_id, item_id, state, data)], [expected])[0]
+
+    def iter_log(self, case_id=None, item_id=None, reverse=False, limit=None, decoded=False):
+        # blocks oldest first, or newest first with reverse, optionally of
+        # one case and one item and at most limit of them. they are read
+        # from a snapshot of the chain taken on the first next(), so appends
+        # made while iterating are not seen. decoded gives (case id, item
+        # id, state, timestamp) tuples instead, see block.BlockDecoder
+        # no block can hold an id that does not fit in one
+        if item_id is not None and not 0 <= item_id < ITEM_ID_LIMIT:
+            return
+        if case_id is not None and not 0 <= case_id < CASE_ID_LIMIT:
+            return
+        self.refresh()
+        columns = self.columns
+        indexes = None
+        if case_id is not None or (columns is None and (reverse or item_id is not None)):
+            # open them before the snapshot so they cannot cover more of the chain
+            indexes = self.indexes
+        reader = self._snapshot()
+        try:
+            # rows from the in memory columns have the same fields as blocks
+            if columns is not None:
+                with profiling.phase("columns"):
+                    columns.extend(reader)
+            block_at = columns.row_at if columns is not None else reader.block_at
+
+            # an item is matched on its raw id against the query packed
+            # once, so the other items' blocks are never decoded
+            key = None if item_id is None else item_key(item_id)
+            # set once the blocks below only come from the item
+            matched = item_id is None
+            if case_id is not None:
+                # only this case's blocks are read, the index can also walk them newest first
+                cases = indexes.cases
+                positions = cases.iter_offsets_reverse(case_id) if reverse else cases.offsets(case_id)
+                # the postings are shared with other writers, skip what they
+                # added after the snapshot
+                positions = (offset for offset in positions if offset < reader.size)
+                if key is not None and columns is None:
+                    positions = (offset for offset in positions if reader.item_bytes(offset) == key)
+                    matched = True
+                blocks = (block_at(offset) for offset in positions)
+            elif columns is not None:
+                blocks = reversed(columns) if reverse else iter(columns)
+            elif item_id is not None:
+                # only the segments that can hold the item are read
+                ranges = indexes.manifest.ranges(item_id=item_id)
+                if reverse:
+                    blocks = (reader.block_at(offset) for _, _, first, stop in reversed(ranges)
+                              for offset in indexes.offsets.iter_reverse(first, stop)
+                              if reader.item_bytes(offset) == key)
+                else:
+                    blocks = (block for start, end, *_ in ranges for block in reader.iter_item(item_id, start, end))
+                matched = True
+            elif reverse:
+                # start at the tail and walk back, so a limit of 5 only reads five blocks
+                blocks = (reader.block_at(offset) for offset in indexes.offsets.iter_reverse())
+            else:
+                blocks = iter(reader)
+            # the in memory columns hold item ids decoded already
+            matches = blocks if matched else (block for block in blocks if block.item_id == item_id)
+
+            if limit:
+                matches = islice(matches, limit)
+            if decoded:
+                matches = BlockDecoder().iter_decoded(matches)
+            yield from matches
+        finally:
+            blocks = matches = None
+            reader.close()
+
+    def prove(self, item_id, n):
+        # an inclusion proof for the item's nth block, counted from 1 oldest
+        # first the way log -i prints them, or from -1 newest first. returns
+        # (raw block, block number, tree size, sibling hashes, root), see
+        # merkle.MerkleTree.proof. only the item's case is read
+        self.refresh()
+        items, cases, _, tree, _, offsets = self.indexes
+        case_id = self._current(item_id)[0]
+        if n == 0:
+            raise ChainError("block numbers count from 1, or back from -1")
+        reader = self._snapshot()
+        try:
+            positions = cases.iter_offsets_reverse(case_id) if n < 0 else cases.offsets(case_id)
+            matches = (offset for offset in positions if reader.block_at(offset).item_id == item_id)
+            offset = next(islice(matches, abs(n) - 1, None), None)
+            if offset is None:
+                raise ChainError(f"item {item_id} has fewer than {abs(n)} blocks")
+            raw = bytes(reader.block_at(offset).raw)
+        finally:
+            reader.close()
+        size = tree.leaves
+        number = offsets.index_of(offset)
+        return raw, number, size, tree.proof(number, size), tree.root(size)
+
+    def hash_name(self):
+        # the block hash the chain is linked with, one of block.HASHES
+        if not os.path.exists(self.path):
+            raise ChainError("blockchain file not found")
+        with open(self.path, "rb") as f:
+            return chain_hash_name(f.fileno())
+
+    def merkle_root(self, size=None):
+        # root of the merkle tree over the first size blocks, all if None
+        self.refresh()
+        return self.indexes.merkle.root(size)
+
+    def segments(self):
+        # the sealed segments, see index.SegmentManifest
+        self.refresh()
+        return self.indexes.manifest.segments
+
+    def verify(self, incremental=False, jobs=1):
+        # checks the whole chain, or with incremental only what was appended
+        # since the last clean verify. returns the verify.ChainVerifier, its
+        # start is 0 when the whole chain was checked. a clean chain with
+        # blocks in it gets a new checkpoint
+        from verify import load_checkpoint, save_checkpoint, segments_intact, verify_chain
+
+        with self._snapshot() as reader:
+            checkpoint = None
+            if incremental:
+                with profiling.phase("checkpoint"):
+                    checkpoint = load_checkpoint(self.path, reader)
+                    # the segments sealed before the checkpoint are not
+                    # read again, only their ends are checked
+                    if checkpoint is not None and not segments_intact(reader, read_segments(self.path),
+                                                                      checkpoint[1]):
+                        checkpoint = None
+            columns = self.columns
+            if columns is not None:
+                with profiling.phase("columns"):
+                    try:
+                        columns.extend(reader)
+                    except ChainError:
+                        # a truncated tail, which verify reports past the
+                        # blocks the columns hold
+                        pass
+            with profiling.phase("verify"):
+                if checkpoint is not None:
+                    verifier = verify_chain(reader, *checkpoint, jobs=jobs, columns=columns)
+                else:
+                    verifier = verify_chain(reader, jobs=jobs, columns=columns)
+            size = reader.size
+        if not verifier.errors and verifier.count:
+            with profiling.phase("checkpoint"):
+                save_checkpoint(self.path, verifier, size)
+        return verifier
+
+    def import_actions(self, stream, fmt, batch_size=None, progress=None):
+        # see bulkimport.import_actions, returns (blocks, seconds). batch_size
+        # None means bulkimport.DEFAULT_BATCH_SIZE
+        from bulkimport import DEFAULT_BATCH_SIZE, import_actions
+
+        self.refresh()
+        return import_actions(self.path, self.indexes, stream, fmt, max(batch_size or DEFAULT_BATCH_SIZE, 1), progress)
+
+    def export(self, out, fmt, case_id=None, item_id=None):
+        # writes the blocks, oldest first and optionally of one case and
+        # item, in one of bulkexport.FORMATS. out is a text stream for jsonl
+        # and csv and a file name for columns. returns how many were written
+        from bulkexport import export_blocks
+
+        blocks = self.iter_log(case_id, item_id)
+        try:
+            return export_blocks(blocks, fmt, out)
+        finally:
+            blocks.close()
+
+    def reindex(self):
+        # rebuilds every sidecar from the chain
+        if self._indexes is None:
+            self._indexes = Indexes._make(index_type(self.path) for index_type in INDEX_TYPES)
+        for index in self._indexes:
+            index.rebuild()
+
+    def close(self):
+        for index in self._indexes or ():
+            index.close()
+        self._indexes = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,357 @@
+import os
+import struct
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from block import HASH_SIZE, NULL_HASH, REMOVED_STATES, STATE_SIZE, BlockReader, ChainError
+from index import CODE_STATES, STATE_CODES
+
+
+PARENT_NOT_FOUND = "Parent block: NOT FOUND"
+DUPLICATE_PARENT = "Two blocks were found with the same parent."
+BAD_INITIAL = "Initial block is missing or malformed."
+BAD_TRANSITION = "Item checked out or checked in after removal from chain."
+INVALID_STATE = "Block has an invalid state for its item."
+TRUNCATED = "Block is truncated."
+
+# written next to the chain after every clean verify. it records how far
+# the chain was checked, the offset and hash of the block at that point and
+# the item states the transition checks had reached, so the next
+# incremental verify can pick up right there
+CHECKPOINT_SUFFIX = ".checkpoint"
+CHECKPOINT_MAGIC = b"BCVC"
+CHECKPOINT_VERSION = 1
+# magic, version, block count, bytes verified, tail block offset, tail hash, item count
+CHECKPOINT_HEADER = struct.Struct(f"<4s I Q Q Q {HASH_SIZE}s Q")
+CHECKPOINT_ITEM = struct.Struct("<I B")
+
+# parallel verify splits the chain into this many segments per worker so a
+# slow segment does not leave the other workers idle at the end
+SEGMENTS_PER_JOB = 4
+# what a worker hands back for each block it hashed: item id, state code
+# (see index.STATE_CODES, 0 for a state that is not one) and whether the
+# block links to the one before it in the segment
+SEGMENT_RECORD = struct.Struct("<I B ?")
+# rows of the in memory columns fed to the verifier at a time
+COLUMN_BATCH = 4096
+_RAW_STATE_CODES = {state.encode().ljust(STATE_SIZE, b"\0"): code for state, code in STATE_CODES.items()}
+
+# which state an item has to be in before a block can move it to the next one.
+# None means the item must not exist yet (an add)
+ALLOWED_FROM = {
+    "CHECKEDIN": (None, "CHECKEDOUT"),
+    "CHECKEDOUT": ("CHECKEDIN",),
+    "DISPOSED": ("CHECKEDIN",),
+    "DESTROYED": ("CHECKEDIN",),
+    "RELEASED": ("CHECKEDIN",),
+}
+
+
+class ChainVerifier:
+    # checks blocks one at a time in chain order. errors are collected as
+    # (block hash, message) pairs in the order they are found
+    def __init__(self):
+        self.count = 0
+        self.errors = []
+        # offset the last verify_chain call started from, 0 for the whole chain
+        self.start = 0
+        self.item_states = {}
+        self.last_hash = None
+        self.last_offset = 0
+        self.mismatches = []
+
+    def feed(self, block, digest, linked=None):
+        # linked is for callers that already compared this block's prev hash
+        # with the digest of the block before it
+        self._feed(block.prev_hash, block.state, block.item_id, digest, linked)
+        self.last_offset = block.offset
+
+    def feed_segment(self, digests, records, prev_hashes, last_offset):
+        # the blocks of a segment as _hash_segment returns them. a linked
+        # block whose state move is allowed only costs the state machine's
+        # dict lookups, anything else goes through the same checks feed does
+        item_states = self.item_states
+        for i, (item_id, code, linked) in enumerate(SEGMENT_RECORD.iter_unpack(records)):
+            state = CODE_STATES.get(code)
+            if linked and self.count:
+                allowed = ALLOWED_FROM.get(state)
+                if allowed is not None and item_states.get(item_id) in allowed:
+                    item_states[item_id] = state
+                    self.count += 1
+                    continue
+            # the first block's link is to the segment before, which is
+            # only known here
+            self._feed(prev_hashes.get(i), state, item_id, digests[i * HASH_SIZE:(i + 1) * HASH_SIZE],
+                       None if i == 0 else linked)
+        if digests:
+            self.last_hash = digests[-HASH_SIZE:]
+            self.last_offset = last_offset
+
+    def _feed(self, prev_hash, state, item_id, digest, linked):
+        if linked is None:
+            linked = prev_hash == self.last_hash
+
+        if self.count == 0:
+            if prev_hash != NULL_HASH or state != "INITIAL":
+                self.errors.append((digest, BAD_INITIAL))
+        elif not linked:
+            # whether this is a missing parent or a fork needs a look back
+            # through the chain, which only happens once the scan is done
+            self.mismatches.append(len(self.errors))
+            self.errors.append((digest, bytes(prev_hash)))
+        elif state == "INITIAL":
+            self.errors.append((digest, BAD_INITIAL))
+
+        if self.count > 0 and state != "INITIAL":
+            self.check_transition(item_id, state, digest)
+
+        self.count += 1
+        self.last_hash = digest
+
+    def check_transition(self, item_id, state, digest):
+        current = self.item_states.get(item_id)
+        allowed = ALLOWED_FROM.get(state)
+        if allowed is None:
+            self.errors.append((digest, INVALID_STATE))
+            return
+        if current not in allowed:
+            if current in REMOVED_STATES:
+                self.errors.append((digest, BAD_TRANSITION))
+            else:
+                self.errors.append((digest, INVALID_STATE))
+            return
+        self.item_states[item_id] = state
+
+    def resolve(self, reader):
+        # turn the recorded prev hashes of mismatched blocks into messages.
+        # a prev hash that matches some earlier block means that block now
+        # has two children, otherwise the parent is gone
+        if not self.mismatches:
+            return
+        wanted = {self.errors[i][1] for i in self.mismatches}
+        seen = set()
+        try:
+            for block in reader:
+                digest = block.hash()
+                if digest in wanted:
+                    seen.add(digest)
+        except ChainError:
+            pass
+        for i in self.mismatches:
+            digest, prev_hash = self.errors[i]
+            message = DUPLICATE_PARENT if prev_hash in seen else PARENT_NOT_FOUND
+            self.errors[i] = (digest, message)
+        self.mismatches = []
+
+
+def save_checkpoint(chain_path, verifier, size):
+    path = chain_path + CHECKPOINT_SUFFIX
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(CHECKPOINT_HEADER.pack(CHECKPOINT_MAGIC, CHECKPOINT_VERSION, verifier.count, size,
+                                       verifier.last_offset, verifier.last_hash, len(verifier.item_states)))
+        f.write(b"".join(CHECKPOINT_ITEM.pack(item_id, STATE_CODES[state])
+                         for item_id, state in verifier.item_states.items()))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(chain_path, reader):
+    # a verifier set up to carry on from the last clean verify and the offset
+    # to carry on from, or None when there is no checkpoint or it no longer
+    # matches the chain
+    path = chain_path + CHECKPOINT_SUFFIX
+    try:
+        with open(path, "rb") as f:
+            header = f.read(CHECKPOINT_HEADER.size)
+            if len(header) != CHECKPOINT_HEADER.size:
+                return None
+            magic, version, count, size, tail_offset, tail_hash, item_count = CHECKPOINT_HEADER.unpack(header)
+            if magic != CHECKPOINT_MAGIC or version != CHECKPOINT_VERSION:
+                return None
+            items = f.read(item_count * CHECKPOINT_ITEM.size)
+    except FileNotFoundError:
+        return None
+    if len(items) != item_count * CHECKPOINT_ITEM.size or size > reader.size:
+        return None
+
+    # the block the checkpoint ended on has to still be there, still end at
+    # the same place and still hash the same
+    try:
+        tail = reader.block_at(tail_offset)
+    except ChainError:
+        return None
+    if tail.end != size or tail.hash() != tail_hash:
+        return None
+
+    verifier = ChainVerifier()
+    verifier.count = count
+    verifier.last_hash = tail_hash
+    verifier.last_offset = tail_offset
+    verifier.item_states = {item_id: CODE_STATES[code] for item_id, code in CHECKPOINT_ITEM.iter_unpack(items)}
+    return verifier, size
+
+
+def segments_intact(reader, segments, size):
+    # whether the sealed segments (see index.SegmentManifest) that lie before
+    # size still start and end with the blocks they were sealed with and
+    # still link up with each other. only those blocks are hashed, so this
+    # catches a chain cut or spliced at a segment edge, not a block changed
+    # in the middle of one
+    last_hash = None
+    for segment in segments:
+        if segment.end > size:
+            break
+        try:
+            first = reader.block_at(segment.start)
+            last = reader.block_at(segment.last)
+        except ChainError:
+            return False
+        if first.hash() != segment.first_hash or last.end != segment.end or last.hash() != segment.last_hash:
+            return False
+        if last_hash is not None and first.prev_hash != last_hash:
+            return False
+        last_hash = segment.last_hash
+    return True
+
+
+def _segment_bounds(reader, start, segments):
+    # cut the chain from start into byte ranges of whole blocks. walking it
+    # only reads each block's data length
+    target = max((reader.size - start) // segments, 1)
+    bounds = [start]
+    cut = start + target
+    for offset in reader.iter_offsets(start):
+        if offset >= cut:
+            bounds.append(offset)
+            cut = offset + target
+    bounds.append(reader.size)
+    return list(zip(bounds, bounds[1:]))
+
+
+def _hash_segment(task):
+    # runs in a worker. hashes every block in [start, end), checks the links
+    # inside the segment and packs what the state machine needs of each
+    # block into SEGMENT_RECORDs. the first block's link is left to the
+    # caller, so its prev hash comes back along with those of any block
+    # that does not link, for the error messages
+    path, start, end = task
+    digests = []
+    records = []
+    prev_hashes = {}
+    last = None
+    last_offset = start
+    pack = SEGMENT_RECORD.pack
+    with BlockReader(path) as reader:
+        for i, block in enumerate(reader.iter_from(start)):
+            if block.offset >= end:
+                break
+            digest = block.hash()
+            prev_hash = block.prev_hash
+            linked = last is not None and prev_hash == last
+            if not linked:
+                prev_hashes[i] = bytes(prev_hash)
+            records.append(pack(block.item_id, _RAW_STATE_CODES.get(bytes(block.state_bytes), 0), linked))
+            digests.append(digest)
+            last = digest
+            last_offset = block.offset
+        block = prev_hash = None
+    return b"".join(digests), b"".join(records), prev_hashes, last_offset
+
+
+def _verify_parallel(reader, verifier, segments, jobs):
+    # workers do the hashing and the links inside their segments. segments
+    # are fed to the verifier in chain order, so the segment edges get
+    # stitched by the usual prev hash check and the errors come out exactly
+    # as a serial pass would report them. the chain itself is not walked
+    # again here
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        # keep a bounded number of segments in flight so digests for the
+        # whole chain never sit in memory at once
+        tasks = iter(segments)
+        pending = deque()
+
+        def submit():
+            segment = next(tasks, None)
+            if segment is not None:
+                pending.append(pool.submit(_hash_segment, (reader.path,) + segment))
+
+        for _ in range(jobs * 2):
+            submit()
+        while pending:
+            result = pending.popleft().result()
+            submit()
+            verifier.feed_segment(*result)
+
+
+def _verify_columns(reader, verifier, columns, start):
+    # the blocks from start with their item ids and states taken from the
+    # in memory columns (see columns.ChainColumns) and replayed through
+    # feed_segment, so the chain is only read to hash each block and check
+    # its link. returns where the columns end, the blocks past that are
+    # left to the caller
+    if columns.end > reader.size:
+        # taken from a later snapshot than this one
+        return start
+    offsets = columns.offsets
+    first = bisect_left(offsets, start)
+    if first == len(offsets) or offsets[first] != start:
+        return start
+    ends = offsets[first + 1:]
+    ends.append(columns.end)
+    item_ids = columns.item_ids
+    states = columns.states
+    block_hash = reader.block_hash
+    pack = SEGMENT_RECORD.pack
+    last = verifier.last_hash
+    for low in range(first, len(offsets), COLUMN_BATCH):
+        high = min(low + COLUMN_BATCH, len(offsets))
+        digests = []
+        records = []
+        prev_hashes = {}
+        for i in range(low, high):
+            raw = reader.raw(offsets[i], ends[i - first])
+            prev_hash = raw[:HASH_SIZE]
+            # the first link is checked by feed_segment, against the batch before
+            linked = i > low and prev_hash == last
+            if not linked:
+                prev_hashes[i - low] = bytes(prev_hash)
+            last = block_hash(raw)
+            digests.append(last)
+            records.append(pack(item_ids[i], states[i], linked))
+        raw = prev_hash = None
+        verifier.feed_segment(b"".join(digests), b"".join(records), prev_hashes, offsets[high - 1])
+    return columns.end
+
+
+def verify_chain(reader, verifier=None, start=0, jobs=1, columns=None):
+    # pass a verifier and offset from load_checkpoint to only check the
+    # blocks after it. columns, the in memory columns of a long running
+    # process, are used for the item ids and states of a serial pass
+    if verifier is None:
+        verifier = ChainVerifier()
+    verifier.start = start
+    segments = None
+    if jobs > 1:
+        try:
+            segments = _segment_bounds(reader, start, jobs * SEGMENTS_PER_JOB)
+        except ChainError:
+            # a truncated tail is left to the serial pass, which reports it
+            pass
+    try:
+        if segments:
+            _verify_parallel(reader, verifier, segments, jobs)
+        else:
+            if columns is not None:
+                start = _verify_columns(reader, verifier, columns, start)
+            for block in reader.iter_from(start):
+                verifier.feed(block, block.hash())
+    except ChainError:
+        verifier.errors.append((verifier.last_hash or NULL_HASH, TRUNCATED))
+    if verifier.count == 0:
+        # an empty chain does not even have its INITIAL block
+        verifier.errors.append((NULL_HASH, BAD_INITIAL))
+    verifier.resolve(reader)
+    return verifier
@@ -0,0 +1,423 @@
+import fcntl
+import marshal
+import os
+import struct
+import time
+
+import durability
+import profiling
+from block import DEFAULT_HASH, HASH_SIZE, HASHES, BlockReader, ChainError, chain_hash, genesis_block, pack_block
+from index import ItemFilter, ItemIndex
+from locking import ChainLock
+
+
+# the tail trailer, <chain>.tail, caches the offset and hash of the last
+# block along with the chain's size and mtime when it was written. if both
+# still match the chain an append can go straight to the end, otherwise the
+# chain was touched by something else and the tail is found by a scan. it
+# also counts the blocks that batched durability has not fsynced yet
+TAIL_SUFFIX = ".tail"
+TAIL_MAGIC = b"BCTL"
+TAIL_VERSION = 2
+# magic, version, chain size, chain mtime in ns, tail block offset, tail
+# hash, unsynced blocks, time the oldest of them was written in ns
+TAIL_FORMAT = struct.Struct(f"<4s I Q Q Q {HASH_SIZE}s Q Q")
+
+# group commit. a writer that finds the chain locked leaves its batch in
+# <chain>.queue as <name>.req and waits for the lock. whoever holds it
+# writes every queued batch along with its own, chained in one write and
+# one fsync, and leaves each waiter a <name>.done with its timestamps. a
+# waiter that gets the lock and finds its batch still queued writes the
+# queue itself. so writers arriving together share an fsync instead of
+# queueing up for one each.
+#
+# a waiter holds a flock on its .req for as long as it waits. one the
+# lock holder can lock has nobody waiting on it any more, its writer died,
+# and is thrown away unwritten rather than recorded in its name
+QUEUE_SUFFIX = ".queue"
+# results nobody came back for within this many seconds are thrown away,
+# and so are requests that old. a waiter whose request went that way still
+# has its batch and writes it itself once it gets the lock
+STALE_RESULT = 60
+# what packing a record can fail with, an id out of range say
+_PACK_ERRORS = (struct.error, OverflowError, TypeError, ValueError, AttributeError)
+
+_queued = 0
+
+
+class ConflictError(ChainError):
+    # an item changed between the caller looking it up and its block being written
+    pass
+
+
+def create_chain(path, algorithm=DEFAULT_HASH):
+    # algorithm is the block hash the chain is linked with, see block.HASHES
+    raw = genesis_block(algorithm)
+    with ChainLock(path):
+        if os.path.exists(path):
+            # another process got there first
+            return
+        with open(path, "wb") as f:
+            f.write(raw)
+            f.flush()
+            os.fsync(f.fileno())
+            save_tail(path, 0, HASHES[algorithm](raw), os.fstat(f.fileno()))
+
+
+def find_tail(reader):
+    # (offset, hash) of the last block by walking the whole chain
+    last = None
+    for block in reader:
+        last = block
+    if last is None:
+        return None, None
+    return last.offset, last.hash()
+
+
+def load_tail(path, st):
+    # (offset, hash, unsynced blocks, oldest unsynced ns) from the trailer
+    # if it still describes the chain as stat'ed
+    try:
+        with open(path + TAIL_SUFFIX, "rb") as f:
+            raw = f.read(TAIL_FORMAT.size)
+    except FileNotFoundError:
+        return None
+    if len(raw) != TAIL_FORMAT.size:
+        return None
+    magic, version, size, mtime_ns, offset, digest, unsynced, unsynced_since = TAIL_FORMAT.unpack(raw)
+    if magic != TAIL_MAGIC or version != TAIL_VERSION:
+        return None
+    if size != st.st_size or mtime_ns != st.st_mtime_ns:
+        return None
+    return offset, digest, unsynced, unsynced_since
+
+
+def save_tail(path, offset, digest, st, unsynced=0, unsynced_since=0):
+    tmp_path = path + TAIL_SUFFIX + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(TAIL_FORMAT.pack(TAIL_MAGIC, TAIL_VERSION, st.st_size, st.st_mtime_ns, offset, digest,
+                                 unsynced, unsynced_since))
+    os.replace(tmp_path, path + TAIL_SUFFIX)
+
+
+def tail_of(path, f):
+    # (offset, hash, unsynced blocks, oldest unsynced ns) of the chain open
+    # as f. a tail found by scanning is taken to have one block unsynced
+    # since the epoch, so the next append fsyncs whatever it missed
+    tail = load_tail(path, os.fstat(f.fileno()))
+    if tail is None:
+        with BlockReader(path) as reader:
+            offset, digest = find_tail(reader)
+        if offset is None:
+            raise ChainError("blockchain file has no INITIAL block")
+        tail = offset, digest, 1, 0
+    return tail
+
+
+def sync_chain(path, indexes):
+    # fsyncs the chain and sidecars if batched durability left blocks
+    # unsynced, for a long running process to call when the time limit
+    # passes with no append to notice it
+    with ChainLock(path):
+        if not os.path.exists(path):
+            return
+        with open(path, "ab") as f:
+            offset, digest, unsynced, _ = tail_of(path, f)
+            if not unsynced:
+                return
+            os.fsync(f.fileno())
+            save_tail(path, offset, digest, os.fstat(f.fileno()))
+        for index in indexes:
+            index.refresh()
+            index.commit(index.chain_size)
+
+
+def append_blocks(path, indexes, records, expected=None):
+    # writes a batch of (case id, item id, state, data) records after the
+    # current tail and returns their timestamps. expected, if given, is the
+    # state each record's item must still be in when the batch is written,
+    # None for an item that must not exist yet. a batch that no longer fits
+    # raises ConflictError and none of it is written
+    if not records:
+        return []
+    lock = ChainLock(path)
+    request = held = None
+    try:
+        with profiling.phase("lock"):
+            if not lock.acquire(blocking=False):
+                request, held = _queue_batch(path, records, expected)
+                # wait shared, so every waiter wakes as soon as the writer is
+                # done and they pick up their results together
+                with ChainLock(path, exclusive=False):
+                    result = _take_result(request)
+                if result is not None:
+                    return _unpack_result(result)
+                lock.acquire()
+        try:
+            if request is not None:
+                result = _take_result(request)
+                if result is not None:
+                    return _unpack_result(result)
+            return _write_group(path, indexes, records, expected, request)
+        finally:
+            lock.release()
+    finally:
+        if request is not None:
+            # whatever happened our batch must not be written later
+            _remove(request + ".req")
+            held.close()
+
+
+def append_block(path, indexes, case_id, item_id, state, data=b"", expected=None):
+    return append_blocks(path, indexes, [(case_id, item_id, state, data)],
+                         None if expected is None else [expected])[0]
+
+
+def _queue_batch(path, records, expected):
+    # the request's name, without .req, and the open file whose lock says
+    # we are still waiting on it
+    global _queued
+    queue = path + QUEUE_SUFFIX
+    os.makedirs(queue, exist_ok=True)
+    _queued += 1
+    # names sort in arrival order
+    name = os.path.join(queue, f"{time.time_ns():020d}-{os.getpid()}-{_queued}")
+    f = open(name + ".tmp", "wb")
+    try:
+        # locked before it is renamed into place, so a .req is never seen unlocked
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        marshal.dump((records, expected), f)
+        f.flush()
+        os.replace(name + ".tmp", name + ".req")
+    except BaseException:
+        f.close()
+        _remove(name + ".tmp")
+        raise
+    return name, f
+
+
+def _remove(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def _waiting(name):
+    # whether the writer that queued name is still waiting for it
+    try:
+        f = open(name + ".req", "rb")
+    except FileNotFoundError:
+        return False
+    with f:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+    return False
+
+
+def _take_result(name):
+    try:
+        with open(name + ".done", "rb") as f:
+            result = marshal.load(f)
+    except FileNotFoundError:
+        return None
+    os.unlink(name + ".done")
+    return result
+
+
+def _unpack_result(result):
+    kind, value = result
+    if kind == "conflict":
+        raise ConflictError(value)
+    if kind == "error":
+        raise ChainError(value)
+    return value
+
+
+def _queued_batches(path, own):
+    # (name, records, expected) of every batch waiting in the queue but our own
+    queue = path + QUEUE_SUFFIX
+    try:
+        entries = os.listdir(queue)
+    except FileNotFoundError:
+        return []
+    stale = time.time() - STALE_RESULT
+    for entry in entries:
+        if entry.endswith((".done", ".req", ".tmp")):
+            # left by a waiter that died before reading it, or that has
+            # been waiting so long it had best write its batch itself
+            old = os.path.join(queue, entry)
+            try:
+                if os.stat(old).st_mtime < stale:
+                    os.unlink(old)
+            except FileNotFoundError:
+                pass
+    names = sorted(entry[:-4] for entry in entries if entry.endswith(".req"))
+    batches = []
+    for name in names:
+        name = os.path.join(queue, name)
+        if name == own:
+            continue
+        if not _waiting(name):
+            # its writer is gone, nobody asked for this any more
+            _remove(name + ".req")
+            continue
+        try:
+            with open(name + ".req", "rb") as f:
+                records, expected = marshal.load(f)
+        except FileNotFoundError:
+            continue
+        except (EOFError, ValueError, TypeError):
+            # not something _queue_batch wrote, nobody is waiting on it
+            _remove(name + ".req")
+            continue
+        batches.append((name, records, expected))
+    return batches
+
+
+def _conflict(item_index, item_filter, pending, records, expected):
+    # why the batch can no longer be written, or None. pending holds the
+    # states batches accepted before this one leave their items in. the
+    # filter, if there is one, answers for items that were never added
+    if expected is None:
+        return None
+    # a batch can act on the same item more than once, bulk imports do
+    batch_states = {}
+    for (_, item_id, new_state, _), want in zip(records, expected):
+        if item_id in batch_states:
+            state = batch_states[item_id]
+        elif item_id in pending:
+            state = pending[item_id]
+        elif item_filter is not None and item_id not in item_filter:
+            state = None
+        else:
+            entry = item_index.get(item_id)
+            state = entry[1] if entry is not None else None
+        if state == want:
+            batch_states[item_id] = new_state
+            continue
+        if want is None:
+            return f"item {item_id} already exists"
+        if state is None:
+            return f"item {item_id} not found"
+        return f"item {item_id} became {state} before the change could be written"
+    return None
+
+
+def _write_group(path, indexes, records, expected, request):
+    # runs under the lock. our batch goes last, after everything that was
+    # waiting for us
+    for index in indexes:
+        # other processes may have written since these were opened
+        index.refresh()
+    group = _queued_batches(path, request)
+    group.append((request, records, expected))
+
+    item_index = next((index for index in indexes if isinstance(index, ItemIndex)), None)
+    item_filter = next((index for index in indexes if isinstance(index, ItemFilter)), None)
+    if item_index is not None and not item_index.filtered:
+        # the index answers faster on its own, see index.FILTER_MIN_INDEX_BYTES
+        item_filter = None
+    own_index = None
+    if item_index is None and any(batch_expected is not None for _, _, batch_expected in group):
+        item_index = own_index = ItemIndex.open(path)
+    results = {}
+    try:
+        with open(path, "a+b") as f:
+            with profiling.phase("tail"):
+                _, prev_hash, unsynced, unsynced_since = tail_of(path, f)
+                offset = f.tell()
+            block_hash = chain_hash(f.fileno())
+            # each batch is checked and packed on its own, so one that
+            # cannot go in gets its error without holding back the rest
+            accepted = []
+            pending = {}
+            for name, batch, batch_expected in group:
+                try:
+                    error = _conflict(item_index, item_filter, pending, batch, batch_expected)
+                    if error is not None:
+                        results[name] = ("conflict", error)
+                        continue
+                    with profiling.phase("hash"):
+                        raws, timestamps, last_hash = _pack_batch(batch, prev_hash, block_hash)
+                except _PACK_ERRORS as e:
+                    results[name] = ("error", f"cannot write the batch: {e}")
+                    continue
+                prev_hash = last_hash
+                for _, item_id, state, _ in batch:
+                    pending[item_id] = state
+                accepted.append((name, batch, raws, timestamps))
+            if accepted:
+                sync = _write_raws(path, f, [raws for _, _, raws, _ in accepted], prev_hash,
+                                   unsynced, unsynced_since)
+    finally:
+        if own_index is not None:
+            own_index.close()
+
+    if accepted:
+        _commit_indexes(indexes, offset, accepted, sync)
+    profiling.count("batches_written", len(accepted))
+    for name, _, _, timestamps in accepted:
+        results[name] = ("ok", timestamps)
+
+    for name, result in results.items():
+        if name is None:
+            continue
+        if name != request:
+            with open(name + ".tmp", "wb") as f:
+                marshal.dump(result, f)
+            os.replace(name + ".tmp", name + ".done")
+        _remove(name + ".req")
+    return _unpack_result(results[request])
+
+
+def _pack_batch(records, prev_hash, block_hash):
+    # the raw blocks of a batch chained on from prev_hash, their
+    # timestamps and the hash of the last one
+    raws = []
+    timestamps = []
+    for case_id, item_id, state, data in records:
+        timestamp = time.time()
+        raw = pack_block(prev_hash, case_id, item_id, state, data, timestamp)
+        raws.append(raw)
+        timestamps.append(timestamp)
+        prev_hash = block_hash(raw)
+    return raws, timestamps, prev_hash
+
+
+def _write_raws(path, f, batches, last_hash, unsynced, unsynced_since):
+    # the packed batches go to disk in one write and at most one fsync.
+    # returns whether they were fsynced
+    raws = [raw for batch in batches for raw in batch]
+    with profiling.phase("write"):
+        f.write(b"".join(raws))
+        f.flush()
+    now = time.time_ns()
+    if not unsynced:
+        unsynced_since = now
+    unsynced += len(raws)
+    sync = durability.current.due(unsynced, unsynced_since, now)
+    if sync:
+        with profiling.phase("fsync"):
+            os.fsync(f.fileno())
+        unsynced = unsynced_since = 0
+    end = f.tell()
+    save_tail(path, end - len(raws[-1]), last_hash, os.fstat(f.fileno()), unsynced, unsynced_since)
+    profiling.count("blocks_written", len(raws))
+    return sync
+
+
+def _commit_indexes(indexes, offset, accepted, sync):
+    # only once the blocks are written do the sidecar indexes move on to
+    # them, with one commit each
+    with profiling.phase("index_commit"):
+        for index in indexes:
+            block_offset = offset
+            for _, batch, raws, _ in accepted:
+                for (case_id, item_id, state, _), raw in zip(batch, raws):
+                    index.record(block_offset, case_id, item_id, state)
+                    block_offset += len(raw)
+            # the sidecars are only fsynced along with the chain
+            index.commit(block_offset, sync)